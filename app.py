@@ -1,238 +1,2388 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-from pymongo import MongoClient
+from pymongo import MongoClient, ReplaceOne
+from pymongo import timeout as mongo_timeout
+from pymongo.errors import DuplicateKeyError, OperationFailure
 from bson.objectid import ObjectId
+from bson.errors import InvalidId
 import json
-import google.generativeai as genai
+import gzip
 import os
 from dotenv import load_dotenv
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import math
+import argparse
+import re
+import unicodedata
+import threading
+import time
+import zlib
+import contextvars
+from contextlib import contextmanager
+import copy
+import hashlib
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+
+try:
+    import orjson
+except ImportError:  # không bắt buộc, fallback về json chuẩn
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # không bắt buộc, chỉ nén gzip
+    brotli = None
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
 
 load_dotenv(".env")
 
-client = MongoClient(os.getenv("MONGO_URI"))
-db = client["badminton_db"]
+
+
+class MongoConnection:
+    """
+    MongoClient tạo lười ở lần dùng đầu tiên trong mỗi process.
+    MongoClient không an toàn khi fork → mỗi worker gunicorn (kể cả khi
+    preload_app) tự tạo client riêng, import module không tốn kết nối.
+    """
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        pid = os.getpid()
+        if self._client is None or self._pid != pid:
+            with self._lock:
+                if self._client is None or self._pid != pid:
+                    self._client = MongoClient(os.getenv("MONGO_URI"), connect=False)
+                    self._pid = pid
+        return self._client
+
+    @property
+    def db(self):
+        return self.client[self.db_name]
+
+
+class LazyDatabase:
+    """Database Mongo dùng như bình thường, client chỉ được tạo khi truy vấn"""
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __getitem__(self, name):
+        return LazyCollection(self._connection, name)
+
+    def __getattr__(self, attr):
+        return getattr(self._connection.db, attr)
+
+
+class LazyCollection:
+    def __init__(self, connection, name):
+        self._connection = connection
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(self._connection.db[self.name], attr)
+
+
+mongo = MongoConnection("badminton_db")
+db = LazyDatabase(mongo)
 users = db["users"]
 trainings = db["trainings"]
 trainingplans = db["trainingplans"]
 meals = db["meals"]
+jobs = db["jobs"]
+courts = db["courts"]
+courttiles = db["courttiles"]
+
+# ========== METRICS ==========
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144)
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "0"))  # 0 = tắt log request chậm
+
+
+class Metrics:
+    """
+    Counter / histogram / gauge trong process, xuất dạng text Prometheus.
+    Mỗi lần ghi chỉ là vài phép cộng dưới 1 lock (vài µs).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist["counts"][i] += 1
+                    break
+            hist["sum"] += value
+            hist["count"] += 1
+
+    def gauge(self, name, fn):
+        """Đăng ký gauge: fn() trả về số, hoặc dict {tuple labels: số}"""
+        self._gauges[name] = fn
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: dict(v, counts=list(v["counts"])) for k, v in self._histograms.items()}
+
+        for name in sorted({k[0] for k in counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for name in sorted({k[0] for k in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (n, labels), hist in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(hist["buckets"], hist["counts"]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {hist['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {round(hist['sum'], 6)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {hist['count']}")
+
+        for name, fn in sorted(self._gauges.items()):
+            try:
+                value = fn()
+            except Exception:
+                continue
+            lines.append(f"# TYPE {name} gauge")
+            if isinstance(value, dict):
+                for labels, v in sorted(value.items()):
+                    lines.append(f"{name}{_format_labels(labels)} {v}")
+            else:
+                lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    inner = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+    return "{" + inner + "}"
+
+
+metrics = Metrics()
+
+# Danh sách (stage, giây) của request / job hiện tại, dùng cho log request chậm
+_current_stages = contextvars.ContextVar("current_stages", default=None)
+
+
+def _add_stage(name, elapsed):
+    stages = _current_stages.get()
+    if stages is not None:
+        stages.append((name, elapsed))
+
+
+@contextmanager
+def stage(name):
+    """Đo thời gian 1 bước xử lý: histogram stage_duration_seconds{stage=...}"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe("stage_duration_seconds", elapsed, stage=name)
+        _add_stage(name, elapsed)
+
+
+@app.before_request
+def _start_request_timer():
+    g.request_start = time.perf_counter()
+    g.stages_token = _current_stages.set([])
+
+
+@app.after_request
+def _record_request(response):
+    start = g.get("request_start")
+    if start is None:
+        return response
+
+    elapsed = time.perf_counter() - start
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.observe("http_request_duration_seconds", elapsed, route=route, method=request.method)
+    metrics.inc("http_requests_total", route=route, method=request.method, status=response.status_code)
+
+    stages = _current_stages.get() or []
+    if SLOW_REQUEST_SECONDS and elapsed >= SLOW_REQUEST_SECONDS:
+        breakdown = ", ".join(f"{name}={t * 1000:.1f}ms" for name, t in stages)
+        print(f"Slow request {request.method} {route} {elapsed * 1000:.1f}ms [{breakdown}]")
+
+    token = g.pop("stages_token", None)
+    if token is not None:
+        _current_stages.reset(token)
+    return response
+
+
+def is_quota_error(e):
+    text = f"{type(e).__name__} {e}".lower()
+    return "429" in text or "quota" in text or "resourceexhausted" in text
+
+
+# ========== JSON / COMPRESSION ==========
+
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+COMPRESS_MIMETYPES = {"application/json", "text/plain"}
+
+
+def json_default(value):
+    """Kiểu có trong document Mongo mà JSON không hỗ trợ sẵn"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def prompt_default(value):
+    """Như json_default nhưng kiểu lạ (Decimal128, Binary, UUID...) thành str: prompt không được lỗi"""
+    try:
+        return json_default(value)
+    except TypeError:
+        return str(value)
+
+
+def dumps_bytes(obj, default=json_default):
+    """JSON UTF-8 (bytes, không escape tiếng Việt), dùng orjson nếu có"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass  # vd số nguyên > 64 bit → để json chuẩn xử lý
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=default).encode("utf-8")
+
+
+def dumps_text(obj, default=json_default):
+    return dumps_bytes(obj, default).decode("utf-8")
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """JSON provider cho Flask: orjson (nếu có), ObjectId / datetime trả thẳng được qua jsonify"""
+
+    def dumps(self, obj, **kwargs):
+        return dumps_text(obj)
+
+    def loads(self, s, **kwargs):
+        if orjson is not None:
+            return orjson.loads(s)
+        return json.loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        # Ghi thẳng bytes, khỏi encode/decode thêm 1 lần
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps_bytes(obj), mimetype=self.mimetype)
+
+
+app.json = FastJSONProvider(app)
+
+
+@app.after_request
+def compress_response(response):
+    """Nén brotli (nếu cài) / gzip cho response JSON, text lớn khi client chấp nhận"""
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or response.status_code in (204, 304)
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESS_MIMETYPES
+    ):
+        return response
+
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+
+    response.vary.add("Accept-Encoding")
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        response.set_data(brotli.compress(data, quality=COMPRESS_LEVEL))
+        response.headers["Content-Encoding"] = "br"
+    elif accepted["gzip"]:
+        response.set_data(gzip.compress(data, compresslevel=COMPRESS_LEVEL))
+        response.headers["Content-Encoding"] = "gzip"
+    return response
+
+
+def conditional_json(build_payload, etag):
+    """
+    Response JSON kèm ETag (weak). If-None-Match khớp → 304, không cần build
+    / serialize payload
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(build_payload())
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+# ========== CATALOG CACHE ==========
+
+CATALOG_TTL_SECONDS = float(os.getenv("CATALOG_TTL_SECONDS", "300"))
+
+TRAINING_FIELDS = {"title": 1, "goal": 1, "level": 1, "description": 1}
+MEAL_FIELDS = {"name": 1, "calories": 1, "goal": 1, "mealType": 1, "description": 1}
+
+
+class CatalogSnapshot:
+    """
+    Ảnh chụp bất biến của catalog (trainings + meals) tại một version
+
+    `version` đổi khi trainings hoặc meals đổi, `training_version` chỉ đổi theo
+    trainings - dùng cho lộ trình (lộ trình không phụ thuộc meals).
+    """
+
+    def __init__(self, version, training_docs, meal_docs, training_version=None):
+        self.version = version
+        self.training_version = version if training_version is None else training_version
+        self.trainings = training_docs
+        self.meals = meal_docs
+        self._training_index = None
+        self._meal_index = None
+        self._goal_buckets = None
+        self._training_by_id = None
+
+    def training_index(self):
+        """Index BM25 của trainings, build 1 lần cho mỗi version"""
+        if self._training_index is None:
+            self._training_index = BM25Index(self.trainings, training_search_text)
+        return self._training_index
+
+    def meal_index(self):
+        """Index BM25 của meals, build 1 lần cho mỗi version"""
+        if self._meal_index is None:
+            self._meal_index = BM25Index(self.meals, meal_search_text)
+        return self._meal_index
+
+    def goal_buckets(self):
+        """goal_key → cấp độ → danh sách id bài tập, build 1 lần cho mỗi version"""
+        if self._goal_buckets is None:
+            buckets = {}
+            for t in self.trainings:
+                raw = t.get("goal")
+                goals = raw if isinstance(raw, list) else split_goals(raw or "")
+                for key in {goal_key(g) for g in goals if g}:
+                    buckets.setdefault(key, {}).setdefault(t.get("level"), []).append(str(t["_id"]))
+            self._goal_buckets = buckets
+        return self._goal_buckets
+
+    def training_by_id(self):
+        if self._training_by_id is None:
+            self._training_by_id = {str(t["_id"]): t for t in self.trainings}
+        return self._training_by_id
+
+    def trainings_for_goals(self, goals):
+        """Bài tập khớp ít nhất 1 goal (tra dict theo từng goal, không quét catalog)"""
+        buckets = self.goal_buckets()
+        by_id = self.training_by_id()
+        seen = set()
+        result = []
+        for goal in goals:
+            for ids in buckets.get(goal_key(goal), {}).values():
+                for training_id in ids:
+                    if training_id not in seen:
+                        seen.add(training_id)
+                        result.append(by_id[training_id])
+        return result
+
+
+class CatalogCache:
+    """
+    Cache trong process cho 2 collection trainings và meals (đã projection).
+
+    - Làm mới qua change stream của Mongo (nếu server hỗ trợ, tức replica set)
+    - Fallback: tự load lại khi quá CATALOG_TTL_SECONDS (chỉ 1 request load,
+      các request khác dùng tạm snapshot cũ)
+    - version: checksum của nội dung catalog, giống nhau giữa các worker
+      nên các tầng khác có thể dùng làm key cache
+    """
+
+    def __init__(self, database, ttl=CATALOG_TTL_SECONDS):
+        self.db = database
+        self.ttl = ttl
+        self._snapshot = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        # Chỉ 1 request load lại khi hết TTL, các request khác dùng tạm snapshot cũ
+        self._refresh_lock = threading.Lock()
+        self._watcher_pid = None
+
+    def _load(self):
+        training_docs = list(self.db["trainings"].find({}, TRAINING_FIELDS))
+        meal_docs = list(self.db["meals"].find({}, MEAL_FIELDS))
+        training_payload = json.dumps(training_docs, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")
+        meal_payload = json.dumps(meal_docs, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")
+        training_version = zlib.crc32(training_payload)
+        version = zlib.crc32(meal_payload, training_version)
+        return CatalogSnapshot(version, training_docs, meal_docs, training_version)
+
+    def refresh(self):
+        """Load lại catalog từ Mongo, trả về snapshot mới"""
+        with stage("catalog_refresh"):
+            snapshot = self._load()
+        metrics.inc("catalog_refresh_total")
+        with self._lock:
+            self._snapshot = snapshot
+            self._loaded_at = time.monotonic()
+        return snapshot
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = 0.0
+
+    def get(self):
+        """Trả về snapshot hiện tại, load lại nếu hết hạn TTL"""
+        self._ensure_watcher()
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return snapshot
+
+        if snapshot is None:
+            # Lần load đầu: không có gì để trả tạm, load luôn (không chờ lock - lock có thể
+            # được tạo trước khi gevent patch nếu preload)
+            return self.refresh()
+
+        # Request khác đang load lại → dùng tạm snapshot cũ, không chờ
+        if not self._refresh_lock.acquire(blocking=False):
+            return snapshot
+        try:
+            return self.refresh()
+        except Exception as e:
+            # Mongo lỗi tạm thời → dùng tạm dữ liệu cũ
+            print(f"Catalog refresh error: {e}")
+            return snapshot
+        finally:
+            self._refresh_lock.release()
+
+    @property
+    def version(self):
+        return self.get().version
+
+    @property
+    def training_version(self):
+        return self.get().training_version
+
+    def _ensure_watcher(self):
+        # Mỗi process (sau khi gunicorn fork) cần thread riêng
+        pid = os.getpid()
+        if self._watcher_pid == pid:
+            return
+        with self._lock:
+            if self._watcher_pid == pid:
+                return
+            self._watcher_pid = pid
+        threading.Thread(target=self._watch, name="catalog-watcher", daemon=True).start()
+
+    def _watch(self):
+        pipeline = [{"$match": {"ns.coll": {"$in": ["trainings", "meals"]}}}]
+        while True:
+            try:
+                with self.db.watch(pipeline) as stream:
+                    for _ in stream:
+                        # Gộp các thay đổi liên tiếp thành 1 lần load lại
+                        while stream.try_next() is not None:
+                            pass
+                        self.refresh()
+            except (NotImplementedError, TypeError, OperationFailure) as e:
+                # Standalone mongod / mongomock không hỗ trợ change stream → chỉ dùng TTL
+                print(f"Catalog change stream unavailable, using TTL polling: {e}")
+                return
+            except Exception as e:
+                # Mất kết nối tạm thời → đánh dấu hết hạn rồi thử mở lại stream
+                print(f"Catalog change stream error: {e}")
+                self.invalidate()
+                time.sleep(5)
+
+
+catalog = CatalogCache(db)
+
+
+# ========== RETRIEVAL (BM25) ==========
+
+CHAT_TRAINING_TOP_K = int(os.getenv("CHAT_TRAINING_TOP_K", "20"))
+CHAT_MEAL_TOP_K = int(os.getenv("CHAT_MEAL_TOP_K", "15"))
+CHAT_CATALOG_TOKEN_BUDGET = int(os.getenv("CHAT_CATALOG_TOKEN_BUDGET", "1500"))
+PLAN_CATALOG_LIMIT = int(os.getenv("PLAN_CATALOG_LIMIT", "60"))
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def fold_text(text):
+    """Chữ thường + bỏ dấu tiếng Việt ("Nâng cao" → "nang cao")"""
+    text = str(text).lower().replace("đ", "d")
+    text = unicodedata.normalize("NFD", text)
+    return "".join(c for c in text if unicodedata.category(c) != "Mn")
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(fold_text(text))
+
+
+def _join_field(value):
+    if isinstance(value, list):
+        return " ".join(str(v) for v in value)
+    return str(value or "")
+
+
+def training_search_text(t):
+    return " ".join([_join_field(t.get(f)) for f in ("title", "goal", "level", "description")])
+
+
+def meal_search_text(m):
+    return " ".join([_join_field(m.get(f)) for f in ("name", "goal", "mealType", "description")])
+
+
+def estimate_tokens(text):
+    # Ước lượng thô ~4 ký tự / token
+    return len(text) // 4 + 1
+
+
+class BM25Index:
+    """Index BM25 đơn giản trong bộ nhớ, không phân biệt dấu tiếng Việt"""
+
+    def __init__(self, docs, text_fn, k1=1.5, b=0.75):
+        self.docs = docs
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.doc_len = []
+
+        for i, doc in enumerate(docs):
+            tokens = tokenize(text_fn(doc))
+            self.doc_len.append(len(tokens))
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, tf in counts.items():
+                self.postings.setdefault(token, []).append((i, tf))
+
+        n = len(docs)
+        self.avgdl = (sum(self.doc_len) / n) if n else 0.0
+        self.idf = {
+            token: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5))
+            for token, p in self.postings.items()
+        }
+
+    def scores(self, query):
+        """Trả về dict {vị trí doc: điểm} cho các doc có ít nhất 1 từ khớp"""
+        scores = {}
+        for token in set(tokenize(query)):
+            idf = self.idf.get(token)
+            if idf is None:
+                continue
+            for i, tf in self.postings[token]:
+                norm = tf + self.k1 * (1 - self.b + self.b * self.doc_len[i] / (self.avgdl or 1))
+                scores[i] = scores.get(i, 0.0) + idf * tf * (self.k1 + 1) / norm
+        return scores
+
+    def search(self, query, k):
+        """Top-k doc liên quan nhất (chỉ doc có điểm > 0)"""
+        scores = self.scores(query)
+        ranked = sorted(scores, key=lambda i: (-scores[i], i))
+        return [self.docs[i] for i in ranked[:k]]
+
+
+def select_trainings(snapshot, query, limit, candidates=None):
+    """
+    Chọn tối đa `limit` bài tập liên quan nhất tới query, chia đều cho các cấp độ
+    để prompt lộ trình vẫn đủ bài cho cả 3 lộ trình
+
+    Args:
+        snapshot: CatalogSnapshot
+        query: chuỗi tìm kiếm (thường là goal)
+        limit: số bài tập tối đa
+        candidates: danh sách bài tập được phép chọn (mặc định: cả catalog)
+    """
+    index = snapshot.training_index()
+    scores = index.scores(query)
+    position = {str(t["_id"]): i for i, t in enumerate(index.docs)}
+
+    pool = candidates if candidates is not None else index.docs
+    ranked = sorted(pool, key=lambda t: -scores.get(position.get(str(t["_id"])), 0.0))
+
+    quota = max(1, limit // len(PLAN_LEVELS))
+    per_level = {}
+    chosen = []
+    rest = []
+    for t in ranked:
+        level = t.get("level")
+        if per_level.get(level, 0) < quota:
+            per_level[level] = per_level.get(level, 0) + 1
+            chosen.append(t)
+        else:
+            rest.append(t)
+
+    return (chosen + rest)[:limit]
+
+
+def within_token_budget(items, budget, text_fn):
+    """Cắt danh sách theo ngân sách token (giữ thứ tự)"""
+    selected = []
+    used = 0
+    for item in items:
+        cost = estimate_tokens(text_fn(item))
+        if selected and used + cost > budget:
+            break
+        selected.append(item)
+        used += cost
+    return selected
+
+
+DEFAULT_GOAL = "Cải thiện kỹ năng cầu lông"
+
+
+def normalize_goal(raw_goal):
+    """Chuẩn hóa goal của user (mảng hoặc chuỗi) thành 1 chuỗi"""
+    if isinstance(raw_goal, list):
+        clean_goal = ", ".join([str(g).strip() for g in raw_goal if g])
+    elif isinstance(raw_goal, str):
+        clean_goal = raw_goal.strip("[]'\" ")
+    else:
+        clean_goal = ""
+
+    return clean_goal or DEFAULT_GOAL
+
+
+def split_goals(clean_goal):
+    """Tách goal (chuỗi nhiều mục tiêu cách nhau dấu phẩy) thành từng goal, bỏ trùng"""
+    goals = []
+    keys = set()
+    for goal in re.split(r"[,;\n]", str(clean_goal)):
+        goal = goal.strip(" []'\"")
+        key = goal_key(goal)
+        if key and key not in keys:
+            keys.add(key)
+            goals.append(goal)
+    return goals
+
+
+def goal_key(goal):
+    """Key so khớp goal: không phân biệt hoa thường, dấu, khoảng trắng thừa"""
+    return " ".join(fold_text(goal).split())
+
+
+PLAN_MIN_TRAININGS = int(os.getenv("PLAN_MIN_TRAININGS", "10"))
+
+
+def get_filtered_trainings(clean_goal):
+    """
+    Bài tập cho prompt lộ trình: tra bucket goal → cấp độ của catalog với từng goal
+    của user. Quá ít thì bổ sung bài liên quan nhất tới goal (BM25), quá nhiều thì
+    giữ top-N; luôn tối đa PLAN_CATALOG_LIMIT bài
+    """
+    snapshot = catalog.get()
+    filtered = snapshot.trainings_for_goals(split_goals(clean_goal))
+
+    if len(filtered) < PLAN_MIN_TRAININGS:
+        matched = {str(t["_id"]) for t in filtered}
+        ranked = select_trainings(snapshot, clean_goal, PLAN_CATALOG_LIMIT)
+        filtered = (filtered + [t for t in ranked if str(t["_id"]) not in matched])[:PLAN_CATALOG_LIMIT]
+    elif len(filtered) > PLAN_CATALOG_LIMIT:
+        filtered = select_trainings(snapshot, clean_goal, PLAN_CATALOG_LIMIT, candidates=filtered)
+
+    return filtered
+
+
+def running_under_gevent():
+    """Worker gunicorn gevent đã monkey-patch socket"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("socket")
+
+
+# Model gán trực tiếp từ ngoài (benchmark) thì _model_pid = None và được dùng nguyên
+model = None
+_model_pid = None
+_model_lock = threading.Lock()
+
+def get_model():
+    """
+    GenerativeModel tạo lười: google.generativeai (import rất nặng) chỉ được
+    import khi cần, và được tạo lại trong process con sau fork.
+    """
+    global model, _model_pid
+    pid = os.getpid()
+    if model is not None and _model_pid in (None, pid):
+        return model
+
+    with _model_lock:
+        if model is None or _model_pid not in (None, pid):
+            import google.generativeai as genai
+
+            # gRPC không nhường CPU cho gevent → dùng REST (requests, đã được patch) khi chạy gevent
+            transport = os.getenv("GEMINI_TRANSPORT") or ("rest" if running_under_gevent() else None)
+            genai.configure(api_key=os.getenv("GOOGLE_API_KEY"), transport=transport)
+            model = genai.GenerativeModel(os.getenv("MODEL_NAME"))
+            _model_pid = pid
+    return model
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker đơn giản cho dịch vụ bên ngoài.
+
+    Sau `failure_threshold` lỗi liên tiếp thì mở mạch trong `reset_timeout` giây,
+    hết thời gian thì cho đúng 1 request thử (half-open). Request thử không báo kết quả
+    sau `reset_timeout` giây nữa thì coi như hết hạn, cho request khác thử lại.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._trial_started = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        """Đang mở mạch và chưa tới lúc thử lại"""
+        opened_at = self._opened_at
+        return opened_at is not None and time.monotonic() - opened_at < self.reset_timeout
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at < self.reset_timeout:
+                return False
+            if self._trial and now - self._trial_started < self.reset_timeout:
+                return False
+            self._trial = True
+            self._trial_started = now
+            return True
+
+    def release_trial(self):
+        """Trả lại lượt thử half-open khi request bị hủy giữa chừng (không thành công, không lỗi)"""
+        with self._lock:
+            self._trial = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial = False
+            if self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    print(f"Circuit '{self.name}' opened after {self._failures} failures")
+                self._opened_at = time.monotonic()
+
+
+class ServiceUnavailable(Exception):
+    """Dịch vụ bên ngoài đang bị circuit breaker chặn"""
+
+
+gemini_breaker = CircuitBreaker(
+    "gemini",
+    failure_threshold=int(os.getenv("GEMINI_BREAKER_THRESHOLD", "3")),
+    reset_timeout=float(os.getenv("GEMINI_BREAKER_RESET_SECONDS", "60")),
+)
+
+
+# ========== GEMINI GOVERNOR ==========
+
+# Ngân sách mỗi phút cho từng process (0 = không giới hạn).
+# Với nhiều worker, đặt = quota / WEB_CONCURRENCY
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "0"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "0"))
+
+# Lane theo thứ tự ưu tiên: (số request chờ tối đa, thời gian chờ tối đa - giây)
+GEMINI_LANES = {
+    "chat": (int(os.getenv("GEMINI_CHAT_QUEUE", "20")), float(os.getenv("GEMINI_CHAT_MAX_WAIT", "10"))),
+    "plan": (int(os.getenv("GEMINI_PLAN_QUEUE", "50")), float(os.getenv("GEMINI_PLAN_MAX_WAIT", "60"))),
+    "batch": (int(os.getenv("GEMINI_BATCH_QUEUE", "1000")), float(os.getenv("GEMINI_BATCH_MAX_WAIT", "600"))),
+}
+
+# Lane mặc định của luồng hiện tại (precompute đặt "batch")
+_gemini_lane = contextvars.ContextVar("gemini_lane", default="plan")
+
+
+class GeminiRateLimited(ServiceUnavailable):
+    """Hàng đợi Gemini quá dài hoặc chờ quá lâu → trả 429 kèm Retry-After"""
+
+    def __init__(self, lane, retry_after):
+        super().__init__(f"Gemini quá tải (lane {lane}), thử lại sau {retry_after}s")
+        self.lane = lane
+        self.retry_after = retry_after
+
+
+class GeminiGovernor:
+    """
+    Token bucket cho số request và số token mỗi phút, kèm hàng đợi theo lane ưu tiên.
+
+    - Request chỉ được gọi Gemini khi các lane ưu tiên cao hơn không còn ai chờ
+      và nó đứng đầu lane của mình (chat > plan > batch)
+    - Lane đầy, hoặc thời gian chờ ước tính vượt max wait → GeminiRateLimited ngay,
+      không để request treo tới timeout của upstream
+    """
+
+    def __init__(self, rpm=GEMINI_RPM, tpm=GEMINI_TPM, lanes=GEMINI_LANES):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.lanes = lanes
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+        self._queues = {lane: deque() for lane in lanes}
+
+    @property
+    def enabled(self):
+        return self.rpm > 0 or self.tpm > 0
+
+    def depth(self, lane):
+        return len(self._queues[lane])
+
+    def acquire(self, lane, tokens):
+        """Chờ tới lượt và trừ ngân sách; hết kiên nhẫn thì raise GeminiRateLimited"""
+        if not self.enabled:
+            return
+        if self.tpm > 0:
+            tokens = min(tokens, self.tpm)
+
+        max_queue, max_wait = self.lanes[lane]
+        ticket = object()
+        start = time.monotonic()
+        with self._cond:
+            queue = self._queues[lane]
+            if len(queue) >= max_queue:
+                self._shed(lane, "queue_full")
+            queue.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    remaining = start + max_wait - now
+                    if self._is_next(lane, ticket):
+                        wait = self._wait_time(tokens)
+                        if wait <= 0:
+                            self._requests -= 1
+                            self._tokens -= tokens
+                            break
+                        if wait > remaining:
+                            self._shed(lane, "budget", wait)
+                        self._cond.wait(wait)
+                    else:
+                        if remaining <= 0:
+                            self._shed(lane, "timeout")
+                        self._cond.wait(remaining)
+            finally:
+                queue.remove(ticket)
+                self._cond.notify_all()
+
+        waited = time.monotonic() - start
+        metrics.observe("gemini_queue_wait_seconds", waited, lane=lane)
+        _add_stage("gemini_queue", waited)
+
+    def exhaust(self):
+        """Gemini báo hết quota → dừng gửi cho tới khi bucket nạp lại"""
+        with self._cond:
+            self._requests = min(self._requests, 0.0)
+            self._tokens = min(self._tokens, 0.0)
+
+    def retry_after(self, lane):
+        """Ước lượng số giây tới khi lane có chỗ, dùng cho header Retry-After"""
+        ahead = 0
+        for name in self.lanes:
+            ahead += len(self._queues[name])
+            if name == lane:
+                break
+        rate = self.rpm / 60 if self.rpm > 0 else 1.0
+        return max(1, math.ceil((ahead + 1 - max(self._requests, 0)) / rate))
+
+    def _shed(self, lane, reason, wait=None):
+        metrics.inc("gemini_shed_total", lane=lane, reason=reason)
+        retry_after = max(1, math.ceil(wait)) if wait else self.retry_after(lane)
+        raise GeminiRateLimited(lane, retry_after)
+
+    def _is_next(self, lane, ticket):
+        for name, queue in self._queues.items():
+            if name == lane:
+                return queue[0] is ticket
+            if queue:
+                return False
+        return False
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm > 0:
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        if self.tpm > 0:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def _wait_time(self, tokens):
+        wait = 0.0
+        if self.rpm > 0 and self._requests < 1:
+            wait = (1 - self._requests) * 60 / self.rpm
+        if self.tpm > 0 and self._tokens < tokens:
+            wait = max(wait, (tokens - self._tokens) * 60 / self.tpm)
+        return wait
+
+
+class InflightCalls:
+    """Single-flight: các lời gọi giống hệt nhau đang chạy dùng chung 1 kết quả"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event(), "result": None, "error": None}
+
+        if not leader:
+            metrics.inc("gemini_coalesced_total")
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call["done"].set()
+
+
+gemini_governor = GeminiGovernor()
+gemini_inflight = InflightCalls()
+
+
+def call_gemini(prompt, lane=None, **kwargs):
+    """
+    Gọi model.generate_content qua governor (ngân sách + lane ưu tiên) và circuit breaker.
+    Lời gọi không stream giống hệt lời gọi đang chạy được gộp làm 1.
+    Với stream=True, kết quả chỉ được ghi nhận khi đã đọc hết stream.
+    """
+    lane = lane or _gemini_lane.get()
+    stream = bool(kwargs.get("stream"))
+    metrics.inc("gemini_requests_total", stream=str(stream).lower(), lane=lane)
+    metrics.observe("gemini_prompt_chars", len(prompt), buckets=SIZE_BUCKETS)
+
+    if stream:
+        return _call_gemini(prompt, lane, kwargs)
+
+    key = hashlib.sha1(json.dumps([prompt, kwargs], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return gemini_inflight.run(key, lambda: _call_gemini(prompt, lane, kwargs))
+
+
+def _call_gemini(prompt, lane, kwargs):
+    if gemini_breaker.is_open:
+        metrics.inc("gemini_rejected_total", reason="circuit_open")
+        raise ServiceUnavailable("Gemini circuit open")
+
+    gemini_governor.acquire(lane, estimate_tokens(prompt))
+
+    if not gemini_breaker.allow():
+        metrics.inc("gemini_rejected_total", reason="circuit_open")
+        raise ServiceUnavailable("Gemini circuit open")
+
+    start = time.perf_counter()
+    try:
+        response = get_model().generate_content(prompt, **kwargs)
+    except Exception as e:
+        _record_gemini_error(e)
+        raise
+
+    if kwargs.get("stream"):
+        return _record_stream(response, start)
+
+    elapsed = time.perf_counter() - start
+    metrics.observe("stage_duration_seconds", elapsed, stage="gemini")
+    _add_stage("gemini", elapsed)
+    metrics.observe("gemini_response_chars", len(response.text or ""), buckets=SIZE_BUCKETS)
+    gemini_breaker.record_success()
+    return response
+
+
+def _record_gemini_error(e):
+    gemini_breaker.record_failure()
+    metrics.inc("gemini_errors_total")
+    if is_quota_error(e):
+        metrics.inc("gemini_quota_errors_total")
+        gemini_governor.exhaust()
+
+
+def _record_stream(response, start):
+    size = 0
+    finished = False
+    try:
+        for chunk in response:
+            size += len(chunk.text or "")
+            yield chunk
+        finished = True
+    except Exception as e:
+        finished = True
+        _record_gemini_error(e)
+        raise
+    finally:
+        # Client ngắt SSE / generator bị close() giữa chừng: không có kết quả để ghi,
+        # nhưng phải trả lượt thử half-open, nếu không breaker chặn Gemini mãi mãi
+        if not finished:
+            gemini_breaker.release_trial()
+    metrics.observe("stage_duration_seconds", time.perf_counter() - start, stage="gemini_stream")
+    metrics.observe("gemini_response_chars", size, buckets=SIZE_BUCKETS)
+    gemini_breaker.record_success()
+
+
+def build_plan_doc(plan, training_map, meta=None):
+    """
+    Chuyển 1 lộ trình (output AI / engine local) thành document trainingplans
+
+    Args:
+        meta: thông tin chủ sở hữu + lần sinh (xem plan_meta), gộp vào document
+    """
+    doc = {
+        "name": plan.get("name", "Lộ trình tập luyện"),
+        "description": plan.get("description", ""),
+        "goal": plan.get("goal", ""),
+        "level": plan.get("level", ""),
+        "type": "weekly",
+        "isActive": True,
+        "planDays": []
+    }
+
+    for day_data in plan.get("days", []):
+        day = {
+            "_id": ObjectId(),
+            "day": day_data.get("day", 1),
+            "workouts": []
+        }
+
+        for w in day_data.get("workouts", []):
+            training_name = w.get("trainingName")
+            training_id = training_map.get(training_name)
+
+            day["workouts"].append({
+                "trainingId": ObjectId(training_id) if training_id else None,
+                "time": w.get("time",""),
+                "note": w.get("note", ""),
+                "order": w.get("order", 0),
+                "_id": ObjectId(),
+            })
+
+        doc["planDays"].append(day)
+
+    if meta:
+        doc.update(meta)
+    return doc
+
+def plan_meta(user_id, clean_goal, profile_key, catalog_version, engine, options=None, generation_id=None):
+    """
+    Chủ sở hữu + metadata lần sinh, lưu kèm mỗi lộ trình
+
+    Args:
+        profile_key: plan_cache_key(goal, user, catalog_version) - lộ trình còn hợp lệ
+            khi key hiện tại của user vẫn giống key này
+        generation_id: id chung cho các lộ trình của cùng 1 lần sinh, để không trộn
+            lộ trình của lần sinh dở dang với bộ cũ (mặc định sinh id mới)
+    """
+    return {
+        "userId": ObjectId(user_id),
+        "sourceGoal": clean_goal,
+        "profileKey": profile_key,
+        "generationId": generation_id or str(ObjectId()),
+        "generation": {
+            "engine": engine,
+            "mode": (options or {}).get("mode") or PLAN_PROMPT_MODE,
+            "model": os.getenv("MODEL_NAME") if engine != "local" else None,
+            "catalogVersion": catalog_version,
+        },
+        "createdAt": datetime.now(timezone.utc),
+    }
+
+def save_plan_to_db(plan, training_map, meta=None):
+    with stage("persist"):
+        inserted = trainingplans.insert_one(build_plan_doc(plan, training_map, meta))
+    return str(inserted.inserted_id)
+
+def save_plans_to_db(plans, training_map, meta=None):
+    """Lưu nhiều lộ trình bằng 1 lần insert_many, trả về danh sách id"""
+    docs = [build_plan_doc(p, training_map, meta) for p in plans]
+    if not docs:
+        return []
+    with stage("persist"):
+        inserted = trainingplans.insert_many(docs)
+    return [str(i) for i in inserted.inserted_ids]
+
+def build_plan_prompt(user_info, trainings_list):
+    """Prompt yêu cầu Gemini tạo cả 3 lộ trình trong 1 JSON"""
+    user_json = dumps_text(user_info, default=prompt_default)
+    training_json = dumps_text(trainings_list, default=prompt_default)
+
+    clean_goal = normalize_goal(user_info.get("goal", DEFAULT_GOAL))
+
+    prompt = (
+    "Bạn là huấn luyện viên cầu lông chuyên nghiệp. Hãy tạo đúng **3 lộ trình tập luyện 1 tuần** cho người dùng này.\n"
+    "Mỗi lộ trình tương ứng với một cấp độ khác nhau:\n"
+    "• Lộ trình 1: Cơ bản\n"
+    "• Lộ trình 2: Trung bình\n"
+    "• Lộ trình 3: Nâng cao\n\n"
+
+    "=== QUY TẮC BẮT BUỘC – KHÔNG ĐƯỢC PHÁ VỠ ===\n"
+    "1. Lộ trình Cơ bản    → CHỈ dùng bài tập có trường \"level\": \"Cơ bản\"\n"
+    "2. Lộ trình Trung bình → CHỈ dùng bài tập có trường \"level\": \"Trung bình\"\n"
+    "3. Lộ trình Nâng cao   → CHỈ dùng bài tập có trường \"level\": \"Nâng cao\"\n"
+    "4. Phải tạo ĐÚNG 7 ngày, theo đúng thứ tự từ 1 đến 7 (không được thiếu, không được đảo thứ tự)\n"
+    "5. Mỗi ngày phải có TỐI THIỂU 3 bài tập, TỐI ĐA 6 bài tập\n"
+    "6. Mọi bài tập bạn chọn BẮT BUỘC PHẢI ĐÚNG THEO MỤC TIÊU CỦA NGƯỜI DÙNG 100%\n"
+    "7. Bắt buộc phải có bài tập không để trainingID là null, nếu không có bài tập thì bỏ qua, 1 buổi tập từ 2 đến 4 bài đều được\n"
+
+    "=== MỤC TIÊU CỦA NGƯỜI DÙNG (bắt buộc dùng đúng) ===\n"
+    f"{clean_goal}\n\n"
+
+    "### Thông tin người dùng:\n"
+    f"{user_json}\n\n"
+
+    "### Danh sách bài tập (chỉ dùng đúng tên trong danh sách này):\n"
+    f"{training_json}\n\n"
+
+    "Trả về đúng định dạng JSON sau, KHÔNG thêm bất kỳ chữ nào ngoài JSON:\n"
+    "{\n"
+    '  "plans": [\n'
+    "    {\n"
+    '      "name": "Lộ trình Cơ bản – Xây dựng nền tảng",\n'
+    '      "description": "Dành cho người mới hoặc ít kinh nghiệm",\n'
+    f'      "goal": "{clean_goal}",\n'
+    '      "level": "Cơ bản",\n'
+    '      "days": [1 đến 7]\n'
+    "    },\n"
+    "    {\n"
+    '      "name": "Lộ trình Trung bình – Tăng tốc độ & sức mạnh",\n'
+    '      "description": "Dành cho người đã có nền tảng, muốn tiến bộ rõ rệt",\n'
+    f'      "goal": "{clean_goal}",\n'
+    '      "level": "Trung bình",\n'
+    '      "days": [ ... ]\n'
+    "    },\n"
+    "    {\n"
+    '      "name": "Lộ trình Nâng cao – Hoàn thiện kỹ chiến thuật",\n'
+    '      "description": "Dành cho người chơi lâu năm hoặc thi đấu",\n'
+    f'      "goal": "{clean_goal}",\n'
+    '      "level": "Nâng cao",\n'
+    '      "days": [ ... ]\n'
+    "    }\n"
+    "  ]\n"
+    "}\n\n"
+    "Mỗi workout phải có đúng 4 trường:\n"
+    "- \"trainingName\": tên chính xác trong danh sách\n"
+    "- \"note\": ghi chú chi tiết, dễ hiểu\n"
+    "- \"time\": giờ bắt đầu tập theo định dạng HH:MM (ví dụ: \"18:00\", \"09:00\", \"20:00\")\n"
+    "- \"order\": số thứ tự trong ngày\n\n"
+    "Chỉ trả về JSON thuần, không ```json, không giải thích."
+)
+    return prompt
+
+def generate_training_plans(user_info, trainings_list):
+    with stage("prompt_build"):
+        prompt = build_plan_prompt(user_info, trainings_list)
+
+    try:
+        response = call_gemini(
+            prompt,
+            generation_config={"response_mime_type": "application/json"}
+        )
+        return response.text
+    except Exception as e:
+        print("Gemini Error:", e)
+        return json.dumps({
+            "plans": [],
+            "error": "Gemini quota exceeded"
+        }, ensure_ascii=False)
+
+def stream_training_plans(user_info, trainings_list):
+    """Giống generate_training_plans nhưng yield từng đoạn text JSON (stream)"""
+    with stage("prompt_build"):
+        prompt = build_plan_prompt(user_info, trainings_list)
+    for chunk in call_gemini(
+        prompt,
+        generation_config={"response_mime_type": "application/json"},
+        stream=True,
+    ):
+        if chunk.text:
+            yield chunk.text
+
+# ========== PLAN VALIDATION / STREAM PARSER ==========
+
+TIME_RE = re.compile(r"^([01]?\d|2[0-3]):([0-5]\d)$")
+MAX_WORKOUTS_PER_DAY = 6
+
+
+class PlanStreamParser:
+    """
+    Parse JSON dạng {"plans": [{...}, {...}]} theo từng chunk, trả về mỗi
+    object lộ trình ngay khi nó đóng ngoặc (không cần chờ hết response).
+    Object lỗi (bị cắt, sai JSON) chỉ bị bỏ qua, không làm hỏng các object khác.
+    """
+
+    def __init__(self):
+        self._stack = []
+        self._buf = []
+        self._capturing = False
+        self._in_string = False
+        self._escape = False
+        self.errors = 0
+
+    @property
+    def incomplete(self):
+        """Stream kết thúc khi đang đọc dở 1 lộ trình (output bị cắt)"""
+        return self._capturing
+
+    def _at_plan_level(self):
+        # Phần tử của mảng "plans" trong object gốc, hoặc của mảng gốc
+        return self._stack == ["{", "["] or self._stack == ["["]
+
+    def feed(self, chunk):
+        done = []
+        for ch in chunk:
+            if self._capturing:
+                self._buf.append(ch)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+
+            if ch == '"':
+                self._in_string = True
+            elif ch == "{" or ch == "[":
+                if ch == "{" and not self._capturing and self._at_plan_level():
+                    self._capturing = True
+                    self._buf = ["{"]
+                self._stack.append(ch)
+            elif ch == "}" or ch == "]":
+                if self._stack:
+                    self._stack.pop()
+                if ch == "}" and self._capturing and self._at_plan_level():
+                    text = "".join(self._buf)
+                    self._capturing = False
+                    self._buf = []
+                    try:
+                        obj = json.loads(text)
+                    except ValueError:
+                        self.errors += 1
+                        continue
+                    if isinstance(obj, dict):
+                        done.append(obj)
+        return done
+
+
+def _workout_order(w):
+    try:
+        return int(w.get("order"))
+    except (TypeError, ValueError):
+        return MAX_WORKOUTS_PER_DAY + 1
+
+
+def validate_plan(plan, training_map, training_levels):
+    """
+    Kiểm tra và sửa nhẹ 1 lộ trình từ AI:
+    - bỏ bài tập không có trong training_map hoặc sai cấp độ lộ trình
+    - đánh lại "order" 1..n, tối đa 6 bài/ngày, giờ sai định dạng → "18:00"
+    - sắp xếp ngày 1 → 7, bỏ ngày trùng
+
+    Returns:
+        (plan đã sửa, None) hoặc (None, lý do không dùng được)
+    """
+    if not isinstance(plan, dict):
+        return None, "Lộ trình không đúng định dạng"
+
+    level = plan.get("level")
+    if level not in [lv for lv, _, _ in PLAN_LEVELS]:
+        return None, f"Cấp độ không hợp lệ: {level}"
+
+    # Chỉ kiểm tra cấp độ bài tập khi catalog có bài tập đúng cấp độ này
+    check_level = level in training_levels.values()
+
+    days = {}
+    for day_data in plan.get("days") or []:
+        if not isinstance(day_data, dict):
+            continue
+        try:
+            day_no = int(day_data.get("day"))
+        except (TypeError, ValueError):
+            continue
+        if not 1 <= day_no <= 7 or day_no in days:
+            continue
+
+        raw_workouts = [w for w in day_data.get("workouts") or [] if isinstance(w, dict)]
+        workouts = []
+        for w in sorted(raw_workouts, key=_workout_order):
+            name = w.get("trainingName")
+            if name not in training_map:
+                continue
+            if check_level and training_levels.get(name) != level:
+                continue
+
+            match = TIME_RE.match(str(w.get("time") or "").strip())
+            workouts.append({
+                "trainingName": name,
+                "note": str(w.get("note") or ""),
+                "time": f"{int(match.group(1)):02d}:{match.group(2)}" if match else "18:00",
+                "order": len(workouts) + 1,
+            })
+            if len(workouts) == MAX_WORKOUTS_PER_DAY:
+                break
+
+        if workouts:
+            days[day_no] = {"day": day_no, "workouts": workouts}
+
+    if len(days) != 7:
+        return None, f"Lộ trình {level} chỉ có {len(days)}/7 ngày hợp lệ"
+
+    repaired = dict(plan)
+    repaired["days"] = [days[d] for d in range(1, 8)]
+    return repaired, None
+
+
+def _accept_plan(plan, valid, training_map, training_levels, errors):
+    """Validate 1 lộ trình, thêm vào `valid` nếu hợp lệ và chưa trùng cấp độ"""
+    repaired, error = validate_plan(plan, training_map, training_levels)
+    if error is None and any(p["level"] == repaired["level"] for p in valid):
+        error = f"Trùng cấp độ {repaired['level']}"
+    if error:
+        errors.append({"level": plan.get("level") if isinstance(plan, dict) else None, "error": error})
+        return None
+    valid.append(repaired)
+    return repaired
+
+
+def validate_plans(plans, training_map, training_levels):
+    """Validate danh sách lộ trình, bỏ lộ trình lỗi hoặc trùng cấp độ"""
+    valid = []
+    errors = []
+    for plan in plans:
+        _accept_plan(plan, valid, training_map, training_levels, errors)
+    return valid, errors
+
+
+def stream_and_validate_plans(user_info, trainings_list, training_map, training_levels, on_plan):
+    """
+    Stream output của Gemini, validate từng lộ trình ngay khi parse xong
+    và gọi on_plan(plan) để lưu luôn, không chờ hết response
+
+    Returns:
+        (danh sách lộ trình hợp lệ, danh sách lỗi)
+    """
+    parser = PlanStreamParser()
+    plans = []
+    errors = []
+    try:
+        for chunk in stream_training_plans(user_info, trainings_list):
+            for plan in parser.feed(chunk):
+                accepted = _accept_plan(plan, plans, training_map, training_levels, errors)
+                if accepted is not None:
+                    on_plan(accepted)
+    except Exception as e:
+        print("Gemini Error:", e)
+        errors.append({"level": None, "error": str(e)})
+
+    if parser.errors:
+        errors.append({"level": None, "error": f"Bỏ qua {parser.errors} lộ trình sai JSON"})
+    if parser.incomplete:
+        errors.append({"level": None, "error": "Output của AI bị cắt giữa chừng"})
+    return plans, errors
+
+# ========== SPLIT PROMPT (3 cấp độ song song) ==========
+
+PLAN_PROMPT_MODE = os.getenv("PLAN_PROMPT_MODE", "single")
+
+PLAN_LEVELS = [
+    ("Cơ bản", "Lộ trình Cơ bản – Xây dựng nền tảng", "Dành cho người mới hoặc ít kinh nghiệm"),
+    ("Trung bình", "Lộ trình Trung bình – Tăng tốc độ & sức mạnh", "Dành cho người đã có nền tảng, muốn tiến bộ rõ rệt"),
+    ("Nâng cao", "Lộ trình Nâng cao – Hoàn thiện kỹ chiến thuật", "Dành cho người chơi lâu năm hoặc thi đấu"),
+]
+
+
+def generate_level_plan(user_info, trainings_list, clean_goal, level, name, description):
+    """
+    Sinh 1 lộ trình cho đúng 1 cấp độ, prompt chỉ chứa bài tập của cấp độ đó
+
+    Returns:
+        dict lộ trình (name, description, goal, level, days). Raise nếu lỗi.
+    """
+    level_trainings = [t for t in trainings_list if t.get("level") == level]
+    if not level_trainings:
+        level_trainings = trainings_list  # không có bài tập đúng cấp độ → dùng tất cả
+
+    user_json = dumps_text(user_info, default=prompt_default)
+    training_json = dumps_text(level_trainings, default=prompt_default)
+
+    prompt = (
+    f"Bạn là huấn luyện viên cầu lông chuyên nghiệp. Hãy tạo đúng **1 lộ trình tập luyện 1 tuần** cấp độ \"{level}\" cho người dùng này.\n\n"
+
+    "=== QUY TẮC BẮT BUỘC – KHÔNG ĐƯỢC PHÁ VỠ ===\n"
+    "1. CHỈ dùng bài tập trong danh sách bên dưới\n"
+    "2. Phải tạo ĐÚNG 7 ngày, theo đúng thứ tự từ 1 đến 7 (không được thiếu, không được đảo thứ tự)\n"
+    "3. Mỗi ngày phải có TỐI THIỂU 3 bài tập, TỐI ĐA 6 bài tập\n"
+    "4. Mọi bài tập bạn chọn BẮT BUỘC PHẢI ĐÚNG THEO MỤC TIÊU CỦA NGƯỜI DÙNG 100%\n"
+    "5. Bắt buộc phải có bài tập không để trainingID là null, nếu không có bài tập thì bỏ qua, 1 buổi tập từ 2 đến 4 bài đều được\n"
+
+    "=== MỤC TIÊU CỦA NGƯỜI DÙNG (bắt buộc dùng đúng) ===\n"
+    f"{clean_goal}\n\n"
+
+    "### Thông tin người dùng:\n"
+    f"{user_json}\n\n"
+
+    "### Danh sách bài tập (chỉ dùng đúng tên trong danh sách này):\n"
+    f"{training_json}\n\n"
+
+    "Trả về đúng định dạng JSON sau, KHÔNG thêm bất kỳ chữ nào ngoài JSON:\n"
+    "{\n"
+    f'  "name": "{name}",\n'
+    f'  "description": "{description}",\n'
+    f'  "goal": "{clean_goal}",\n'
+    f'  "level": "{level}",\n'
+    '  "days": [1 đến 7]\n'
+    "}\n\n"
+    "Mỗi workout phải có đúng 4 trường:\n"
+    "- \"trainingName\": tên chính xác trong danh sách\n"
+    "- \"note\": ghi chú chi tiết, dễ hiểu\n"
+    "- \"time\": giờ bắt đầu tập theo định dạng HH:MM (ví dụ: \"18:00\", \"09:00\", \"20:00\")\n"
+    "- \"order\": số thứ tự trong ngày\n\n"
+    "Chỉ trả về JSON thuần, không ```json, không giải thích."
+)
+
+    response = call_gemini(
+        prompt,
+        generation_config={"response_mime_type": "application/json"}
+    )
+    plan = json.loads(response.text)
+
+    # Model đôi khi vẫn bọc trong {"plans": [...]}
+    if isinstance(plan.get("plans"), list) and plan["plans"]:
+        plan = plan["plans"][0]
+
+    plan.setdefault("name", name)
+    plan.setdefault("description", description)
+    plan["goal"] = plan.get("goal") or clean_goal
+    plan["level"] = level
+    return plan
+
+
+def generate_training_plans_split(user_info, trainings_list):
+    """
+    Giống generate_training_plans nhưng gửi 3 prompt nhỏ (mỗi cấp độ 1 prompt)
+    song song. Cấp độ nào lỗi thì bỏ qua, vẫn trả về các cấp độ còn lại.
+    """
+    clean_goal = normalize_goal(user_info.get("goal", DEFAULT_GOAL))
+
+    with ThreadPoolExecutor(max_workers=len(PLAN_LEVELS), thread_name_prefix="plan-level") as pool:
+        # Mỗi thread chạy trong bản sao context hiện tại (giữ lane Gemini + stage)
+        futures = [
+            (level, pool.submit(
+                contextvars.copy_context().run,
+                generate_level_plan, user_info, trainings_list, clean_goal, level, name, description
+            ))
+            for level, name, description in PLAN_LEVELS
+        ]
+
+        plans = []
+        errors = []
+        for level, future in futures:
+            try:
+                plans.append(future.result())
+            except Exception as e:
+                print(f"Gemini Error ({level}):", e)
+                errors.append({"level": level, "error": str(e)})
+
+    result = {"plans": plans}
+    if errors:
+        result["errors"] = errors
+    if not plans:
+        result["error"] = "Gemini quota exceeded"
+    return json.dumps(result, ensure_ascii=False)
+
+
+# ========== LOCAL PLAN ENGINE ==========
+
+PLAN_ENGINE = os.getenv("PLAN_ENGINE", "gemini")
+
+# Thời lượng mỗi bài (phút) theo cấp độ, dùng để tính giờ bắt đầu từng bài
+LOCAL_WORKOUT_MINUTES = {"Cơ bản": 15, "Trung bình": 20, "Nâng cao": 25}
+
+
+def generate_local_plans(clean_goal, trainings_list):
+    """
+    Sinh 3 lộ trình 7 ngày không cần Gemini, theo đúng các quy tắc trong prompt:
+    lọc theo cấp độ, 3–6 bài mỗi ngày, giờ HH:MM, chỉ dùng bài tập có trong danh sách.
+    Kết quả xác định (cùng input → cùng output), đúng định dạng save_plan_to_db.
+    """
+    plans = []
+    for level, name, description in PLAN_LEVELS:
+        candidates = [t for t in trainings_list if t.get("level") == level] or trainings_list
+        n = len(candidates)
+        days = []
+
+        for day in range(1, 8):
+            count = min(n, 3 + (day - 1) % 4)  # 3, 4, 5, 6, 3, 4, 5
+            start = ((day - 1) * 3) % n if n else 0
+            hour, minute = (8, 0) if day >= 6 else (18, 0)  # cuối tuần tập buổi sáng
+
+            workouts = []
+            for order in range(1, count + 1):
+                t = candidates[(start + order - 1) % n]
+                desc = (t.get("description") or "").strip()
+                workouts.append({
+                    "trainingName": t["title"],
+                    "note": desc[:150] if desc else f"Thực hiện bài {t['title']} đúng kỹ thuật",
+                    "time": f"{hour:02d}:{minute:02d}",
+                    "order": order,
+                })
+                minute += LOCAL_WORKOUT_MINUTES.get(level, 20)
+                hour, minute = hour + minute // 60, minute % 60
+
+            days.append({"day": day, "workouts": workouts})
+
+        plans.append({
+            "name": name,
+            "description": description,
+            "goal": clean_goal,
+            "level": level,
+            "days": days,
+        })
+
+    return {"plans": plans}
+
+
+# ========== PLAN CACHE ==========
+
+PLAN_CACHE_SIZE = int(os.getenv("PLAN_CACHE_SIZE", "256"))
+PLAN_CACHE_TTL_SECONDS = int(os.getenv("PLAN_CACHE_TTL_SECONDS", "86400"))
+PLAN_CACHE_MONGO = os.getenv("PLAN_CACHE_MONGO", "0") == "1"
+
+
+def profile_bucket(user_info):
+    """Nhóm thô của user: hiện tại chỉ theo trình độ cầu lông"""
+    level = goal_key(user_info.get("badmintonLevel") or "")
+    return level or "unknown"
+
+
+def plan_cache_key(clean_goal, user_info, catalog_version):
+    # Cùng cách tách / so khớp goal với bucket bài tập và chat_bucket
+    goals = sorted(goal_key(g) for g in split_goals(clean_goal))
+    raw = "|".join([",".join(goals), profile_bucket(user_info), str(catalog_version)])
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class PlanCache:
+    """
+    Cache kết quả "plans" đã parse từ Gemini.
+
+    LRU trong process, có thể lưu thêm vào 1 collection Mongo (TTL index)
+    để các worker gunicorn dùng chung.
+    """
+
+    def __init__(self, max_size=PLAN_CACHE_SIZE, ttl=PLAN_CACHE_TTL_SECONDS, collection=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.collection = collection
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._indexed = False
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                expires_at, plans = item
+                if expires_at > now:
+                    self._items.move_to_end(key)
+                    return copy.deepcopy(plans)
+                del self._items[key]
+
+        if self.collection is None:
+            return None
+
+        try:
+            doc = self.collection.find_one({
+                "_id": key,
+                "expiresAt": {"$gt": datetime.now(timezone.utc)}
+            })
+        except Exception as e:
+            print(f"Plan cache read error: {e}")
+            return None
+
+        if not doc:
+            return None
+
+        self._store(key, doc["plans"])
+        return copy.deepcopy(doc["plans"])
+
+    def set(self, key, plans):
+        self._store(key, copy.deepcopy(plans))
+
+        if self.collection is None:
+            return
+
+        try:
+            if not self._indexed:
+                self.collection.create_index("expiresAt", expireAfterSeconds=0)
+                self._indexed = True
+            self.collection.replace_one(
+                {"_id": key},
+                {
+                    "_id": key,
+                    "plans": plans,
+                    "expiresAt": datetime.now(timezone.utc) + timedelta(seconds=self.ttl),
+                },
+                upsert=True,
+            )
+        except Exception as e:
+            print(f"Plan cache write error: {e}")
+
+    def _store(self, key, plans):
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, plans)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+plan_cache = PlanCache(collection=db["plancache"] if PLAN_CACHE_MONGO else None)
+
+
+class InvalidAIOutput(ValueError):
+    """Gemini trả về text không parse được thành JSON"""
+
+    def __init__(self, raw):
+        super().__init__("AI trả về không đúng JSON")
+        self.raw = raw
+
+
+def prepare_trainings(clean_goal):
+    """
+    Lọc bài tập theo goal
+
+    Returns:
+        (trainings_list cho prompt, training_map tên → id, training_levels tên → cấp độ)
+    """
+    training_docs = get_filtered_trainings(clean_goal)
+
+    trainings_list = []
+    training_map = {}
+    training_levels = {}
+
+    for t in training_docs:
+        name = t.get("title")
+        if not name:
+            continue
+
+        trainings_list.append({
+            "title": name,
+            "goal": t.get("goal"),
+            "level": t.get("level"),
+            "description": t.get("description", ""),
+        })
+
+        training_map[name] = str(t["_id"])
+        training_levels[name] = t.get("level")
+
+    return trainings_list, training_map, training_levels
+
+
+def generate_plans(user, clean_goal, trainings_list, training_map, training_levels, options=None, on_plan=None):
+    """
+    Sinh 3 lộ trình (cache → Gemini → engine local), chưa lưu DB
+
+    Args:
+        on_plan: callback(plan) cho chế độ stream, gọi ngay khi mỗi lộ trình hợp lệ
+
+    Returns:
+        (plans, plan_errors, engine, cached)
+    """
+    options = options or {}
+    engine = options.get("engine") or PLAN_ENGINE
+
+    # --- Cache kết quả theo goal + trình độ + version catalog ---
+    cache_key = plan_cache_key(clean_goal, user, catalog.training_version)
+    plans = None
+    # ?regenerate=1: user muốn lộ trình mới → không lấy từ cache
+    if engine != "local" and not options.get("regenerate"):
+        with stage("plan_cache"):
+            plans = plan_cache.get(cache_key)
+        metrics.inc("cache_requests_total", cache="plan", result="hit" if plans is not None else "miss")
+    cached = plans is not None
+    plan_errors = None
+
+    if not cached and engine != "local" and not gemini_breaker.is_open:
+        mode = options.get("mode") or PLAN_PROMPT_MODE
+        if mode == "stream":
+            plans, plan_errors = stream_and_validate_plans(
+                user, trainings_list, training_map, training_levels, on_plan or (lambda plan: None)
+            )
+        else:
+            if mode == "split":
+                ai_output = generate_training_plans_split(user, trainings_list)
+            else:
+                ai_output = generate_training_plans(user, trainings_list)
+
+            with stage("parse"):
+                try:
+                    json_output = json.loads(ai_output)
+                except Exception:
+                    raise InvalidAIOutput(ai_output)
+
+                plans, plan_errors = validate_plans(json_output.get("plans", []), training_map, training_levels)
+            plan_errors = (json_output.get("errors") or []) + plan_errors
+
+        # Không cache kết quả lỗi hoặc thiếu cấp độ
+        if len(plans) == len(PLAN_LEVELS) and not plan_errors:
+            plan_cache.set(cache_key, plans)
+
+    # --- Engine local: được chọn, circuit Gemini đang mở, hoặc Gemini lỗi ---
+    if not plans:
+        engine = "local"
+        with stage("local_engine"):
+            plans = generate_local_plans(clean_goal, trainings_list)["plans"]
+        plan_errors = None
+
+    return plans, plan_errors, "cache" if cached else engine, cached
+
+
+def build_training_plan(user_id, options=None, on_plan_saved=None):
+    """
+    Sinh và lưu 3 lộ trình cho user
+
+    Args:
+        user_id: id của user
+        options: tùy chọn từ query string (vd: {"mode": "split"})
+        on_plan_saved: callback(plan_id) gọi ngay khi mỗi lộ trình được lưu
+
+    Returns:
+        (payload, status_code) - payload là dict trả về cho client
+    """
+
+    # 1️⃣ Lấy user
+    with stage("user_lookup"):
+        user = users.find_one({"_id": ObjectId(user_id)}, {"passwordHash": 0})
+    if not user:
+        return {"error": "User không tồn tại"}, 404
+
+    user["_id"] = str(user["_id"])
+
+    # --- Chuẩn hóa goal ---
+    clean_goal = normalize_goal(user.get("goal", []))
+
+    # --- Lọc bài tập theo goal ---
+    with stage("filter_trainings"):
+        trainings_list, training_map, training_levels = prepare_trainings(clean_goal)
+
+    catalog_version = catalog.training_version
+    profile_key = plan_cache_key(clean_goal, user, catalog_version)
+    generation_id = str(ObjectId())
+    saved_ids = []
+
+    def persist(plan):
+        # Chế độ stream: lưu từng lộ trình ngay khi parse + validate xong
+        meta = plan_meta(user_id, clean_goal, profile_key, catalog_version, "gemini", options, generation_id)
+        plan_id = save_plan_to_db(plan, training_map, meta)
+        saved_ids.append(plan_id)
+        if on_plan_saved:
+            on_plan_saved(plan_id)
+
+    try:
+        plans, plan_errors, engine, cached = generate_plans(
+            user, clean_goal, trainings_list, training_map, training_levels, options, on_plan=persist
+        )
+    except InvalidAIOutput as e:
+        return {
+            "error": "AI trả về không đúng JSON",
+            "raw": e.raw
+        }, 400
+
+    # Lộ trình chưa lưu (cache, engine local, chế độ không stream) → 1 lần insert_many
+    meta = plan_meta(user_id, clean_goal, profile_key, catalog_version, engine, options, generation_id)
+    for plan_id in save_plans_to_db(plans[len(saved_ids):], training_map, meta):
+        saved_ids.append(plan_id)
+        if on_plan_saved:
+            on_plan_saved(plan_id)
+
+    payload = {
+        "message": "Đã tạo và lưu 3 lộ trình thành công",
+        "planIds": saved_ids,
+        "plans": plans,
+        "cached": cached,
+        "engine": engine
+    }
+    if plan_errors:
+        payload["errors"] = plan_errors
+
+    return payload, 200
+
+
+# ========== USER PLAN STORE ==========
+
+USER_PLANS_PAGE_SIZE = int(os.getenv("USER_PLANS_PAGE_SIZE", "20"))
+USER_PLANS_MAX_PAGE_SIZE = 100
+
+# Danh sách: bỏ planDays (phần nặng nhất) trừ khi client yêu cầu
+PLAN_SUMMARY_FIELDS = {
+    "name": 1, "description": 1, "goal": 1, "level": 1, "type": 1, "isActive": 1,
+    "userId": 1, "sourceGoal": 1, "generation": 1, "createdAt": 1,
+}
+
+_plan_indexes_ready = False
+
+def ensure_plan_indexes():
+    global _plan_indexes_ready
+    if _plan_indexes_ready:
+        return
+    # Danh sách lộ trình của user, mới nhất trước (phân trang theo _id)
+    trainingplans.create_index([("userId", 1), ("_id", -1)])
+    # Lộ trình còn hợp lệ: cùng user + goal + trình độ + version catalog
+    trainingplans.create_index([("userId", 1), ("profileKey", 1), ("_id", -1)])
+    _plan_indexes_ready = True
+
+
+# Số document tối đa duyệt khi tìm bộ lộ trình đủ cấp độ (bỏ qua các lần sinh dở dang)
+STORED_PLANS_SCAN_LIMIT = len(PLAN_LEVELS) * 5
+
+
+def find_valid_plans(user_id):
+    """
+    Bộ lộ trình mới nhất của user còn khớp goal + trình độ + catalog hiện tại.
+
+    Chỉ nhận 1 lần sinh (cùng generationId) có đủ các cấp độ khác nhau; lần sinh
+    dở dang (stream / split lưu được 1-2 lộ trình) không được trộn với bộ cũ.
+
+    Returns:
+        (user, danh sách document) - user None nếu không tồn tại,
+        danh sách rỗng nếu cần sinh lại
+    """
+    with stage("user_lookup"):
+        user = users.find_one({"_id": ObjectId(user_id)}, {"passwordHash": 0})
+    if not user:
+        return None, []
+
+    ensure_plan_indexes()
+    clean_goal = normalize_goal(user.get("goal", []))
+    profile_key = plan_cache_key(clean_goal, user, catalog.training_version)
+    with stage("stored_plans"):
+        docs = latest_complete_generation(user["_id"], profile_key)
+    return user, docs
+
+
+def latest_complete_generation(user_oid, profile_key, projection=None):
+    """
+    Các document của lần sinh mới nhất có đủ cấp độ, theo thứ tự lưu.
+    Danh sách rỗng nếu không có lần sinh nào đủ → cần sinh lại.
+    """
+    cursor = (
+        trainingplans.find({"userId": user_oid, "profileKey": profile_key}, projection)
+        .sort("_id", -1)
+        .limit(STORED_PLANS_SCAN_LIMIT)
+    )
+    generations = {}
+    for doc in cursor:
+        generation_id = doc.get("generationId")
+        if not generation_id:
+            continue
+        docs = generations.setdefault(generation_id, [])
+        docs.append(doc)
+        if len({d.get("level") for d in docs}) >= len(PLAN_LEVELS):
+            docs.reverse()
+            return docs
+    return []
 
-def get_filtered_trainings(clean_goal):
-    # 1) Lọc theo goal (hỗ trợ goal dạng chuỗi hoặc mảng)
-    query = {
-        "$or": [
-            {"goal": clean_goal},
-            {"goal": {"$in": [clean_goal]}},
-        ]
+
+def stored_plans_payload(docs):
+    return {
+        "message": "Lộ trình hiện có của người dùng",
+        "planIds": [str(d["_id"]) for d in docs],
+        "plans": docs,
+        "cached": True,
+        "engine": "stored",
     }
 
-    filtered = list(trainings.find(query))
 
-    # 2) Fallback nếu số bài tập quá ít (< 10)
-    if len(filtered) < 10:
-        filtered = list(trainings.find({}))  # fallback lấy tất cả
+def list_user_plans(user_id, limit=USER_PLANS_PAGE_SIZE, cursor=None, include_days=False):
+    """
+    Lộ trình của user, mới nhất trước, phân trang theo cursor (= _id cuối trang trước)
 
-    return filtered
+    Returns:
+        (danh sách document, cursor trang sau hoặc None)
+    """
+    ensure_plan_indexes()
+    query = {"userId": ObjectId(user_id)}
+    if cursor:
+        query["_id"] = {"$lt": ObjectId(cursor)}
 
+    projection = None if include_days else PLAN_SUMMARY_FIELDS
+    docs = list(trainingplans.find(query, projection).sort("_id", -1).limit(limit + 1))
 
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-model = genai.GenerativeModel(os.getenv("MODEL_NAME"))
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = str(docs[-1]["_id"])
+    return docs, next_cursor
 
-def save_plan_to_db(plan, training_map):
-    doc = {
-        "name": plan.get("name", "Lộ trình tập luyện"),
-        "description": plan.get("description", ""),
-        "goal": plan.get("goal", ""),
-        "level": plan.get("level", ""),
-        "type": "weekly",
-        "isActive": True,
-        "planDays": []
-    }
 
-    for day_data in plan.get("days", []):
-        day = {
-            "_id": ObjectId(),
-            "day": day_data.get("day", 1),
-            "workouts": []
-        }
+# ========== BATCH PRECOMPUTE ==========
 
-        for w in day_data.get("workouts", []):
-            training_name = w.get("trainingName")
-            training_id = training_map.get(training_name)
+PRECOMPUTE_BATCH_SIZE = int(os.getenv("PRECOMPUTE_BATCH_SIZE", "1000"))
 
-            day["workouts"].append({
-                "trainingId": ObjectId(training_id) if training_id else None,
-                "time": w.get("time",""),
-                "note": w.get("note", ""),
-                "order": w.get("order", 0),
-                "_id": ObjectId(),
-            })
 
-        doc["planDays"].append(day)
+def precompute_plans(concurrency=4, options=None, limit=None):
+    """
+    Sinh trước lộ trình cho toàn bộ user (chạy ban đêm).
 
-    inserted = trainingplans.insert_one(doc)
-    return str(inserted.inserted_id)
+    User được gom nhóm theo goal đã chuẩn hóa + trình độ, mỗi nhóm chỉ sinh 1 lần
+    (song song tối đa `concurrency` nhóm), rồi ghi cho cả nhóm bằng insert_many.
+    User đã có bộ lộ trình đủ cấp độ cho key hiện tại được bỏ qua, trừ khi
+    options["regenerate"].
 
-def generate_training_plans(user_info, trainings_list):
-    user_json = json.dumps(user_info, ensure_ascii=False, default=str)
-    training_json = json.dumps(trainings_list, ensure_ascii=False)
+    Returns:
+        dict thống kê
+    """
+    ensure_plan_indexes()
+    version = catalog.training_version
+    regenerate = (options or {}).get("regenerate")
+    groups = {}
 
-    raw_goal = user_info.get("goal", "Cải thiện kỹ năng cầu lông")
+    cursor = users.find({}, {"passwordHash": 0}).batch_size(500)
+    if limit:
+        cursor = cursor.limit(limit)
 
-    if isinstance(raw_goal, list):
-        clean_goal = ", ".join([str(item).strip() for item in raw_goal if item])
-    elif isinstance(raw_goal, str):
-        clean_goal = raw_goal.strip("[]'\" ")
-    else:
-        clean_goal = "Cải thiện kỹ năng cầu lông"
-    if not clean_goal:
-        clean_goal = "Cải thiện kỹ năng cầu lông"
+    user_count = 0
+    skipped = 0
+    for user in cursor:
+        user_count += 1
+        clean_goal = normalize_goal(user.get("goal", []))
+        key = plan_cache_key(clean_goal, user, version)
+        # User đã có bộ lộ trình đủ cấp độ cho key hiện tại → không ghi thêm bộ mới
+        if not regenerate and latest_complete_generation(user["_id"], key, {"generationId": 1, "level": 1}):
+            skipped += 1
+            continue
+        group = groups.get(key)
+        if group is None:
+            user["_id"] = str(user["_id"])
+            groups[key] = {"user": user, "goal": clean_goal, "key": key, "userIds": [user["_id"]]}
+        else:
+            group["userIds"].append(str(user["_id"]))
 
-    prompt = (
-    "Bạn là huấn luyện viên cầu lông chuyên nghiệp. Hãy tạo đúng **3 lộ trình tập luyện 1 tuần** cho người dùng này.\n"
-    "Mỗi lộ trình tương ứng với một cấp độ khác nhau:\n"
-    "• Lộ trình 1: Cơ bản\n"
-    "• Lộ trình 2: Trung bình\n"
-    "• Lộ trình 3: Nâng cao\n\n"
+    def run_group(group):
+        # Precompute dùng lane thấp nhất, nhường quota cho chat / lộ trình
+        _gemini_lane.set("batch")
+        trainings_list, training_map, training_levels = prepare_trainings(group["goal"])
+        plans, _, engine, _ = generate_plans(
+            group["user"], group["goal"], trainings_list, training_map, training_levels, options
+        )
 
-    "=== QUY TẮC BẮT BUỘC – KHÔNG ĐƯỢC PHÁ VỠ ===\n"
-    "1. Lộ trình Cơ bản    → CHỈ dùng bài tập có trường \"level\": \"Cơ bản\"\n"
-    "2. Lộ trình Trung bình → CHỈ dùng bài tập có trường \"level\": \"Trung bình\"\n"
-    "3. Lộ trình Nâng cao   → CHỈ dùng bài tập có trường \"level\": \"Nâng cao\"\n"
-    "4. Phải tạo ĐÚNG 7 ngày, theo đúng thứ tự từ 1 đến 7 (không được thiếu, không được đảo thứ tự)\n"
-    "5. Mỗi ngày phải có TỐI THIỂU 3 bài tập, TỐI ĐA 6 bài tập\n"
-    "6. Mọi bài tập bạn chọn BẮT BUỘC PHẢI ĐÚNG THEO MỤC TIÊU CỦA NGƯỜI DÙNG 100%\n"
-    "7. Bắt buộc phải có bài tập không để trainingID là null, nếu không có bài tập thì bỏ qua, 1 buổi tập từ 2 đến 4 bài đều được\n"
+        written = 0
+        batch = []
+        for user_id in group["userIds"]:
+            # Mỗi user 1 generationId riêng
+            meta = plan_meta(user_id, group["goal"], group["key"], version, engine, options)
+            batch.extend(build_plan_doc(p, training_map, meta) for p in plans)
+            if len(batch) >= PRECOMPUTE_BATCH_SIZE:
+                trainingplans.insert_many(batch)
+                written += len(batch)
+                batch = []
+        if batch:
+            trainingplans.insert_many(batch)
+            written += len(batch)
+        return written, engine
 
-    "=== MỤC TIÊU CỦA NGƯỜI DÙNG (bắt buộc dùng đúng) ===\n"
-    f"{clean_goal}\n\n"
+    stats = {"users": user_count, "skipped": skipped, "groups": len(groups), "plans": 0, "failedGroups": 0, "engines": {}}
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="precompute") as pool:
+        futures = [pool.submit(run_group, g) for g in groups.values()]
+        for future in futures:
+            try:
+                written, engine = future.result()
+            except Exception as e:
+                print(f"Precompute error: {e}")
+                stats["failedGroups"] += 1
+                continue
+            stats["plans"] += written
+            stats["engines"][engine] = stats["engines"].get(engine, 0) + 1
 
-    "### Thông tin người dùng:\n"
-    f"{user_json}\n\n"
+    return stats
 
-    "### Danh sách bài tập (chỉ dùng đúng tên trong danh sách này):\n"
-    f"{training_json}\n\n"
 
-    "Trả về đúng định dạng JSON sau, KHÔNG thêm bất kỳ chữ nào ngoài JSON:\n"
-    "{\n"
-    '  "plans": [\n'
-    "    {\n"
-    '      "name": "Lộ trình Cơ bản – Xây dựng nền tảng",\n'
-    '      "description": "Dành cho người mới hoặc ít kinh nghiệm",\n'
-    f'      "goal": "{clean_goal}",\n'
-    '      "level": "Cơ bản",\n'
-    '      "days": [1 đến 7]\n'
-    "    },\n"
-    "    {\n"
-    '      "name": "Lộ trình Trung bình – Tăng tốc độ & sức mạnh",\n'
-    '      "description": "Dành cho người đã có nền tảng, muốn tiến bộ rõ rệt",\n'
-    f'      "goal": "{clean_goal}",\n'
-    '      "level": "Trung bình",\n'
-    '      "days": [ ... ]\n'
-    "    },\n"
-    "    {\n"
-    '      "name": "Lộ trình Nâng cao – Hoàn thiện kỹ chiến thuật",\n'
-    '      "description": "Dành cho người chơi lâu năm hoặc thi đấu",\n'
-    f'      "goal": "{clean_goal}",\n'
-    '      "level": "Nâng cao",\n'
-    '      "days": [ ... ]\n'
-    "    }\n"
-    "  ]\n"
-    "}\n\n"
-    "Mỗi workout phải có đúng 4 trường:\n"
-    "- \"trainingName\": tên chính xác trong danh sách\n"
-    "- \"note\": ghi chú chi tiết, dễ hiểu\n"
-    "- \"time\": giờ bắt đầu tập theo định dạng HH:MM (ví dụ: \"18:00\", \"09:00\", \"20:00\")\n"
-    "- \"order\": số thứ tự trong ngày\n\n"
-    "Chỉ trả về JSON thuần, không ```json, không giải thích."
+# ========== JOB QUEUE ==========
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_TIMEOUT_SECONDS = int(os.getenv("JOB_TIMEOUT_SECONDS", "120"))
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", "86400"))
+# Thời gian chờ của chế độ đồng bộ: phải ngắn hơn hẳn timeout của worker gunicorn
+# (bị kill thì client nhận 502 thay vì 504 + jobId để poll /jobs/<id>)
+JOB_SYNC_WAIT_SECONDS = min(
+    int(os.getenv("JOB_SYNC_WAIT_SECONDS", "25")),
+    int(os.getenv("GUNICORN_TIMEOUT", "120")) // 2,
 )
 
-    try:
-        response = model.generate_content(
-            prompt,
-            generation_config=genai.types.GenerationConfig(
-                response_mime_type="application/json"
-            )
+
+class PlanJobQueue:
+    """
+    Hàng đợi job sinh lộ trình.
+
+    - Job lưu trong Mongo nên worker gunicorn nào cũng trả lời được /jobs/<id>
+    - Thread pool giới hạn JOB_WORKERS job chạy song song trong 1 process
+    - Single-flight: trường "inflight" (unique, sparse) = userId|goal khi job
+      còn đang chạy, request trùng sẽ nhận lại job đang chạy
+    """
+
+    def __init__(self, collection, workers=JOB_WORKERS):
+        self.collection = collection
+        self.workers = workers
+        self._executor = None
+        self._pid = None
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._indexed = False
+
+    def _get_executor(self):
+        # Thread pool không sống sót qua fork → tạo lại trong mỗi process
+        pid = os.getpid()
+        with self._lock:
+            if self._pid != pid:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="plan-job")
+                self._futures = {}
+                self._pid = pid
+            return self._executor
+
+    def _ensure_indexes(self):
+        if self._indexed:
+            return
+        self.collection.create_index("inflight", unique=True, sparse=True)
+        self.collection.create_index("createdAt", expireAfterSeconds=JOB_RETENTION_SECONDS)
+        self._indexed = True
+
+    def submit(self, user_id, options=None):
+        """
+        Tạo job mới (hoặc trả về job đang chạy cùng user + goal)
+
+        Args:
+            user_id: id của user
+            options: tùy chọn truyền cho build_training_plan
+
+        Returns:
+            (job_doc, created) hoặc (None, False) nếu user không tồn tại
+        """
+        user = users.find_one({"_id": ObjectId(user_id)}, {"goal": 1})
+        if not user:
+            return None, False
+
+        self._ensure_indexes()
+
+        goal = normalize_goal(user.get("goal", []))
+        # Cùng cách chuẩn hóa goal với plan_cache_key: thứ tự, hoa thường, dấu không tạo job mới
+        goals = sorted(goal_key(g) for g in split_goals(goal))
+        inflight_key = f"{user_id}|{','.join(goals)}"
+
+        for _ in range(3):
+            now = datetime.now(timezone.utc)
+            job = {
+                "_id": uuid.uuid4().hex,
+                "userId": user_id,
+                "goal": goal,
+                "status": "queued",
+                "inflight": inflight_key,
+                "options": options or {},
+                "planIds": [],
+                "createdAt": now,
+                "updatedAt": now,
+            }
+            try:
+                self.collection.insert_one(job)
+            except DuplicateKeyError:
+                existing = self.collection.find_one({"inflight": inflight_key})
+                if existing is None:
+                    continue  # job cũ vừa xong, thử tạo lại
+                if not self._is_stale(existing):
+                    return existing, False
+                # Worker chạy job cũ đã chết → giải phóng key
+                self._finish(existing["_id"], "failed", {"error": "Job bị gián đoạn"}, 500)
+                continue
+
+            future = self._get_executor().submit(self._run, job["_id"], user_id, options)
+            with self._lock:
+                self._futures[job["_id"]] = future
+            future.add_done_callback(lambda _f, job_id=job["_id"]: self._futures.pop(job_id, None))
+            return job, True
+
+        raise RuntimeError("Không tạo được job")
+
+    def get(self, job_id):
+        return self.collection.find_one({"_id": job_id})
+
+    def wait(self, job_id, timeout=JOB_SYNC_WAIT_SECONDS):
+        """Chờ job xong (hoặc hết timeout), trả về job doc mới nhất"""
+        future = self._futures.get(job_id)
+        if future is not None:
+            try:
+                future.result(timeout=timeout)
+            except FutureTimeoutError:
+                pass
+            return self.get(job_id)
+
+        # Job do process khác chạy → poll Mongo
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            if job is None or job["status"] in ("done", "failed") or time.monotonic() >= deadline:
+                return job
+            time.sleep(0.5)
+
+    def _is_stale(self, job):
+        updated_at = job.get("updatedAt")
+        if updated_at is None:
+            return True
+        if updated_at.tzinfo is None:
+            updated_at = updated_at.replace(tzinfo=timezone.utc)
+        return datetime.now(timezone.utc) - updated_at > timedelta(seconds=JOB_TIMEOUT_SECONDS)
+
+    def _run(self, job_id, user_id, options=None):
+        stages = []
+        _current_stages.set(stages)
+        self.collection.update_one(
+            {"_id": job_id},
+            {"$set": {"status": "running", "updatedAt": datetime.now(timezone.utc)}}
         )
-        return response.text
-    except Exception as e:
-        print("Gemini Error:", e)
-        return json.dumps({
-            "plans": [],
-            "error": "Gemini quota exceeded"
-        }, ensure_ascii=False)
+        try:
+            with stage("plan_job"):
+                payload, status_code = build_training_plan(
+                    user_id, options, on_plan_saved=lambda plan_id: self._push_plan_id(job_id, plan_id)
+                )
+        except Exception as e:
+            print(f"Plan job {job_id} error: {e}")
+            payload, status_code = {"error": f"Lỗi khi tạo lộ trình: {str(e)}"}, 500
 
-@app.route("/recommend/training-plan/<user_id>", methods=["GET"])
-def recommend_training_plan(user_id):
+        status = "done" if status_code == 200 else "failed"
+        self._finish(job_id, status, payload, status_code, stages)
 
-    # 1️⃣ Lấy user
-    user = users.find_one({"_id": ObjectId(user_id)}, {"passwordHash": 0})
-    if not user:
-        return jsonify({"error": "User không tồn tại"}), 404
+    def _push_plan_id(self, job_id, plan_id):
+        # Client poll /jobs/<id> thấy lộ trình đầu tiên ngay khi được lưu
+        self.collection.update_one(
+            {"_id": job_id},
+            {"$push": {"planIds": plan_id}, "$set": {"updatedAt": datetime.now(timezone.utc)}}
+        )
 
-    user["_id"] = str(user["_id"])
+    def _finish(self, job_id, status, payload, status_code, stages=None):
+        now = datetime.now(timezone.utc)
+        self.collection.update_one(
+            {"_id": job_id},
+            {
+                "$set": {
+                    "status": status,
+                    "result": payload,
+                    "statusCode": status_code,
+                    "planIds": payload.get("planIds", []),
+                    "stages": [[name, round(t, 6)] for name, t in stages or []],
+                    "updatedAt": now,
+                    "finishedAt": now,
+                },
+                "$unset": {"inflight": ""},
+            }
+        )
 
-    # --- Chuẩn hóa goal ---
-    raw_goal = user.get("goal", [])
 
-    if isinstance(raw_goal, list):
-        clean_goal = ", ".join([str(g).strip() for g in raw_goal if g])
-    elif isinstance(raw_goal, str):
-        clean_goal = raw_goal.strip("[]'\" ")
-    else:
-        clean_goal = ""
+plan_jobs = PlanJobQueue(jobs)
 
-    if not clean_goal:
-        clean_goal = "Cải thiện kỹ năng cầu lông"
 
-    # --- Lọc bài tập theo goal (đã sửa) ---
-    training_docs = get_filtered_trainings(clean_goal)
+def plan_options(args):
+    """Lấy các tùy chọn sinh lộ trình từ query string"""
+    options = {k: args[k] for k in ("mode", "engine") if args.get(k)}
+    if args.get("regenerate", "").lower() in ("1", "true"):
+        options["regenerate"] = True
+    return options
 
-    trainings_list = []
-    training_map = {}
 
-    for t in training_docs:
-        name = t.get("title")
-        if not name:
-            continue
+def job_response(job):
+    res = {
+        "jobId": job["_id"],
+        "status": job["status"],
+        "planIds": job.get("planIds", []),
+        "statusUrl": f"/jobs/{job['_id']}",
+    }
+    if job["status"] == "failed":
+        res["error"] = (job.get("result") or {}).get("error")
+    return res
 
-        trainings_list.append({
-            "title": name,
-            "goal": t.get("goal"),
-            "level": t.get("level"),
-            "description": t.get("description", ""),
-        })
 
-        training_map[name] = str(t["_id"])
+@app.route("/recommend/training-plan/<user_id>", methods=["POST"])
+def submit_training_plan(user_id):
+    """
+    Tạo job sinh lộ trình, trả về jobId ngay để client poll /jobs/<jobId>.
+    User đã có lộ trình còn hợp lệ → trả về luôn (200), trừ khi ?regenerate=1
+    """
+    try:
+        stored = stored_plans_response(user_id)
+        if stored is not None:
+            return stored
+        job, _ = plan_jobs.submit(user_id, plan_options(request.args))
+    except InvalidId:
+        return jsonify({"error": "userId không hợp lệ"}), 400
+
+    if job is None:
+        return jsonify({"error": "User không tồn tại"}), 404
+
+    return jsonify(job_response(job)), 202
 
-    ai_output = generate_training_plans(user, trainings_list)
 
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    """Trạng thái job: queued | running | done | failed"""
+    job = plan_jobs.get(job_id)
+    if not job:
+        return jsonify({"error": "Job không tồn tại"}), 404
+
+    return jsonify(job_response(job))
+
+
+@app.route("/recommend/training-plan/<user_id>", methods=["GET"])
+def recommend_training_plan(user_id):
+    """
+    Chế độ đồng bộ: tạo job rồi chờ kết quả.
+    User đã có lộ trình còn hợp lệ → trả về luôn, trừ khi ?regenerate=1
+    """
     try:
-        json_output = json.loads(ai_output)
-    except Exception:
+        stored = stored_plans_response(user_id)
+        if stored is not None:
+            return stored
+        job, _ = plan_jobs.submit(user_id, plan_options(request.args))
+    except InvalidId:
+        return jsonify({"error": "userId không hợp lệ"}), 400
+
+    if job is None:
+        return jsonify({"error": "User không tồn tại"}), 404
+
+    with stage("job_wait"):
+        job = plan_jobs.wait(job["_id"])
+
+    # Gộp thời gian từng bước của job vào request (cho log request chậm)
+    for name, elapsed in (job or {}).get("stages", []):
+        _add_stage(name, elapsed)
+    if job is None or job["status"] not in ("done", "failed"):
         return jsonify({
-            "error": "AI trả về không đúng JSON",
-            "raw": ai_output
-        }), 400
+            "error": "Quá thời gian chờ tạo lộ trình",
+            "jobId": job["_id"] if job else None
+        }), 504
 
-    plans = json_output.get("plans", [])
+    return jsonify(job["result"]), job.get("statusCode", 200)
 
-    saved_ids = [save_plan_to_db(p, training_map) for p in plans]
 
-    return jsonify({
-        "message": "Đã tạo và lưu 3 lộ trình thành công",
-        "planIds": saved_ids,
-        "plans": plans
-    })
+def stored_plans_response(user_id):
+    """Response lộ trình đã lưu còn hợp lệ, None nếu cần sinh mới"""
+    if plan_options(request.args).get("regenerate"):
+        return None
+    _, docs = find_valid_plans(user_id)
+    if not docs:
+        return None
+    # Lộ trình đã lưu không bị sửa → ETag theo danh sách id là đủ
+    etag = hashlib.sha1(",".join(str(d["_id"]) for d in docs).encode("utf-8")).hexdigest()
+    return conditional_json(lambda: stored_plans_payload(docs), etag)
+
+
+@app.route("/users/<user_id>/training-plans", methods=["GET"])
+def user_training_plans(user_id):
+    """
+    Danh sách lộ trình đã lưu của user, mới nhất trước
+
+    Query:
+        limit: số lộ trình mỗi trang (mặc định 20, tối đa 100)
+        cursor: nextCursor của trang trước
+        days=1: kèm planDays (mặc định chỉ trả thông tin tóm tắt)
+    """
+    try:
+        limit = int(request.args.get("limit", USER_PLANS_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "limit không hợp lệ"}), 400
+    limit = max(1, min(limit, USER_PLANS_MAX_PAGE_SIZE))
+
+    include_days = request.args.get("days", "").lower() in ("1", "true")
+    try:
+        docs, next_cursor = list_user_plans(
+            user_id,
+            limit=limit,
+            cursor=request.args.get("cursor"),
+            include_days=include_days,
+        )
+    except InvalidId:
+        return jsonify({"error": "userId hoặc cursor không hợp lệ"}), 400
+
+    raw = "|".join([",".join(str(d["_id"]) for d in docs), str(next_cursor), str(include_days)])
+    etag = hashlib.sha1(raw.encode("utf-8")).hexdigest()
+    return conditional_json(lambda: {"plans": docs, "nextCursor": next_cursor}, etag)
 
 
-def get_training_list():
-    """Lấy danh sách bài tập từ database"""
-    training_docs = list(trainings.find({}, {"title": 1, "goal": 1, "level": 1, "description": 1}).limit(30))
+def get_training_list(query=None):
+    """
+    Lấy danh sách bài tập từ catalog
+
+    Args:
+        query: câu hỏi của người dùng, nếu có thì chỉ lấy top-k bài tập liên quan
+               trong ngân sách token CHAT_CATALOG_TOKEN_BUDGET
+    """
+    snapshot = catalog.get()
+    training_docs = snapshot.trainings[:CHAT_TRAINING_TOP_K]
+    if query:
+        hits = snapshot.training_index().search(query, CHAT_TRAINING_TOP_K)
+        if hits:
+            training_docs = within_token_budget(hits, CHAT_CATALOG_TOKEN_BUDGET // 2, training_search_text)
     training_list = []
     
     for t in training_docs:
@@ -246,36 +2396,241 @@ def get_training_list():
     
     return training_list
 
-def get_meal_list():
-    """Lấy danh sách món ăn từ database"""
-    meal_docs = list(meals.find({}, {"name": 1, "calories": 1, "goal": 1, "mealType": 1, "description": 1}).limit(30))
-    meal_list = []
-    
-    for m in meal_docs:
-        if m.get("name"):
-            meal_list.append({
-                "name": m.get("name"),
-                "calories": m.get("calories", 0),
-                "goal": m.get("goal", ""),
-                "mealType": m.get("mealType", ""),
-                "description": m.get("description", "")[:100] if m.get("description") else ""
-            })
-    
-    return meal_list
+def get_meal_list(query=None):
+    """
+    Lấy danh sách món ăn từ catalog
+
+    Args:
+        query: câu hỏi của người dùng, nếu có thì chỉ lấy top-k món ăn liên quan
+    """
+    snapshot = catalog.get()
+    meal_docs = snapshot.meals[:CHAT_MEAL_TOP_K]
+    if query:
+        hits = snapshot.meal_index().search(query, CHAT_MEAL_TOP_K)
+        if hits:
+            meal_docs = within_token_budget(hits, CHAT_CATALOG_TOKEN_BUDGET // 2, meal_search_text)
+    meal_list = []
+    
+    for m in meal_docs:
+        if m.get("name"):
+            meal_list.append({
+                "name": m.get("name"),
+                "calories": m.get("calories", 0),
+                "goal": m.get("goal", ""),
+                "mealType": m.get("mealType", ""),
+                "description": m.get("description", "")[:100] if m.get("description") else ""
+            })
+    
+    return meal_list
+
+# ========== CHAT ANSWER CACHE ==========
+
+CHAT_CACHE_SIZE = int(os.getenv("CHAT_CACHE_SIZE", "2000"))
+CHAT_CACHE_TTL_SECONDS = int(os.getenv("CHAT_CACHE_TTL_SECONDS", "21600"))
+CHAT_CACHE_THRESHOLD = float(os.getenv("CHAT_CACHE_THRESHOLD", "0.8"))
+
+# Từ dừng (đã bỏ dấu) - không mang nghĩa khi so khớp câu hỏi
+# Từ dừng viết có dấu: so khớp trước khi bỏ dấu, để "cơ bản" không bị coi là "có bạn",
+# "thể lực" không thành "thế"
+CHAT_STOP_WORDS = {
+    "a", "à", "ạ", "ah", "ak", "anh", "bạn", "các", "cái", "cho", "chị", "chỉ", "có", "của",
+    "đã", "đang", "để", "được", "em", "gì", "giúp", "hả", "hay", "hỏi", "không", "ko", "là",
+    "làm", "mình", "một", "nào", "này", "nhé", "nhỉ", "như", "những", "ơi", "phải", "ra", "rồi",
+    "sao", "thế", "thì", "tôi", "từ", "và", "vậy", "về", "với", "xin", "chào",
+}
+# Câu gõ không dấu: chỉ bỏ các từ dừng mà dạng không dấu không trùng từ có nghĩa
+# ("co" = có / cơ, "the" = thế / thể, "toi" = tôi / tối, "nhe" = nhé / nhẹ...)
+CHAT_STOP_WORDS_FOLDED = {fold_text(w) for w in CHAT_STOP_WORDS} - {
+    "ban", "chi", "co", "da", "dang", "de", "hoi", "la", "mot", "nao", "nhe", "roi", "the", "thi",
+    "toi", "tu", "va",
+}
+WORD_RE = re.compile(r"\w+")
+
+
+def normalize_question(question):
+    """Chữ thường, bỏ từ dừng (so khớp trên từ còn dấu), rồi bỏ dấu"""
+    words = WORD_RE.findall(unicodedata.normalize("NFC", str(question).lower()))
+    kept = []
+    for word in words:
+        if word in CHAT_STOP_WORDS:
+            continue
+        folded = fold_text(word)
+        if folded == word and folded in CHAT_STOP_WORDS_FOLDED:
+            continue
+        kept.extend(tokenize(folded))
+    return " ".join(kept)
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# Trường hồ sơ tạo nên chat_bucket - prompt của câu trả lời được cache chỉ chứa các trường này
+CHAT_BUCKET_FIELDS = ("badmintonLevel", "goal")
+
+
+def bucket_profile(user_info):
+    """
+    Phần hồ sơ user dùng chung được trong cùng chat_bucket (trình độ + mục tiêu).
+    Tên, chiều cao, cân nặng, kinh nghiệm không được vào prompt của câu trả lời sẽ
+    cache, nếu không câu trả lời nhắc tới chúng sẽ bị trả cho user khác.
+    """
+    if not user_info:
+        return None
+    return {k: user_info[k] for k in CHAT_BUCKET_FIELDS if k in user_info}
+
+
+def chat_bucket(user_info, catalog_version):
+    """Nhóm dùng chung câu trả lời: trình độ + mục tiêu + version catalog"""
+    if not user_info:
+        return f"anonymous|{catalog_version}"
+    level = fold_text(user_info.get("badmintonLevel") or "")
+    goals = sorted(goal_key(g) for g in split_goals(normalize_goal(user_info.get("goal", []))))
+    return "|".join([level, ",".join(goals), str(catalog_version)])
+
+
+class ChatAnswerCache:
+    """
+    Cache câu trả lời /chat theo câu hỏi đã chuẩn hóa, khớp cả câu gần giống
+    (Jaccard trên trigram ký tự >= threshold) trong cùng bucket.
+    LRU + TTL, có bộ đếm hit/miss.
+    """
+
+    def __init__(self, max_size=CHAT_CACHE_SIZE, ttl=CHAT_CACHE_TTL_SECONDS, threshold=CHAT_CACHE_THRESHOLD):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self._entries = OrderedDict()  # id → (bucket, norm, grams, answer, expires_at)
+        self._exact = {}               # (bucket, norm) → id
+        self._grams = {}               # bucket → {trigram → set(id)}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, question, bucket):
+        norm = normalize_question(question)
+        with self._lock:
+            entry_id = self._exact.get((bucket, norm)) if norm else None
+            near = False
+            if entry_id is None and norm:
+                entry_id = self._most_similar(bucket, trigrams(norm))
+                near = entry_id is not None
+
+            entry = self._entries.get(entry_id) if entry_id is not None else None
+            if entry is not None and entry[4] <= time.monotonic():
+                self._remove(entry_id)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+            if near:
+                self.near_hits += 1
+            return entry[3]
+
+    def set(self, question, bucket, answer):
+        norm = normalize_question(question)
+        if not norm or self.max_size <= 0:
+            return
+
+        grams = trigrams(norm)
+        with self._lock:
+            old_id = self._exact.get((bucket, norm))
+            if old_id is not None:
+                self._remove(old_id)
+
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (bucket, norm, grams, answer, time.monotonic() + self.ttl)
+            self._exact[(bucket, norm)] = entry_id
+            index = self._grams.setdefault(bucket, {})
+            for g in grams:
+                index.setdefault(g, set()).add(entry_id)
+
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "nearHits": self.near_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hitRate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+    def _most_similar(self, bucket, grams):
+        index = self._grams.get(bucket)
+        if not index:
+            return None
+
+        overlap = {}
+        for g in grams:
+            for entry_id in index.get(g, ()):
+                overlap[entry_id] = overlap.get(entry_id, 0) + 1
+
+        best_id = None
+        best_score = self.threshold
+        for entry_id, common in overlap.items():
+            score = common / (len(grams) + len(self._entries[entry_id][2]) - common)
+            if score >= best_score:
+                best_id, best_score = entry_id, score
+        return best_id
 
-def ask_gemini(question: str, training_list: list, meal_list: list, user_info: dict = None) -> str:
+    def _remove(self, entry_id):
+        bucket, norm, grams, _, _ = self._entries.pop(entry_id)
+        self._exact.pop((bucket, norm), None)
+        index = self._grams.get(bucket, {})
+        for g in grams:
+            ids = index.get(g)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del index[g]
+        if not index:
+            self._grams.pop(bucket, None)
+
+
+chat_cache = ChatAnswerCache()
+
+
+CHAT_ERROR_MESSAGE = "Xin lỗi, có lỗi xảy ra khi xử lý câu hỏi của bạn. Vui lòng thử lại sau."
+
+def chat_greeting(user_info: dict = None) -> str:
+    """Lời chào cá nhân, ghép ngoài phần trả lời để câu trả lời dùng chung được giữa các user"""
+    user_name = user_info.get("name") if user_info else None
+    return f"Chào {user_name}!" if user_name else "Chào bạn!"
+
+def build_chat_prompt(question: str, training_list: list, meal_list: list, user_info: dict = None) -> str:
     """
-    Gửi câu hỏi + dữ liệu bài tập và món ăn cho Gemini AI, trả về text tư vấn về cầu lông
-    
+    Tạo prompt chatbot từ câu hỏi + dữ liệu bài tập và món ăn
+
     Args:
         question: Câu hỏi của người dùng
         training_list: Danh sách bài tập
         meal_list: Danh sách món ăn
         user_info: Thông tin người dùng (optional)
     """
+    return build_chat_prefix(training_list, meal_list, user_info) + f"Khách hàng hỏi: {question}\n"
+
+def build_chat_prefix(training_list: list, meal_list: list, user_info: dict = None) -> str:
+    """
+    Phần cố định của prompt chat: giới thiệu app, thông tin user, bài tập,
+    món ăn và hướng dẫn trả lời (không gồm câu hỏi)
+    """
     
     training_lines = []
-    for t in training_list[:20]:  
+    for t in training_list:
         level = t.get("level", "Chưa xác định")
         goal = t.get("goal", "Chưa xác định")
         desc = t.get("description", "")
@@ -287,7 +2642,7 @@ def ask_gemini(question: str, training_list: list, meal_list: list, user_info: d
     training_text = "\n".join(training_lines) if training_lines else "Chưa có bài tập nào"
     
     meal_lines = []
-    for m in meal_list[:15]:  
+    for m in meal_list:
         calories = m.get("calories", 0)
         goal = m.get("goal", "")
         meal_type = m.get("mealType", "")
@@ -307,17 +2662,19 @@ def ask_gemini(question: str, training_list: list, meal_list: list, user_info: d
         else:
             goals_str = str(user_goals) if user_goals else ""
         
-        user_context = f"""
-Thông tin người dùng:
-- Tên: {user_info.get('name', 'N/A')}
-- Trình độ: {user_info.get('badmintonLevel', 'Chưa xác định')}
-- Kinh nghiệm: {user_info.get('badmintonExperience', 'Chưa xác định')}
-- Mục tiêu: {goals_str if goals_str else 'Chưa xác định'}
-- Chiều cao: {user_info.get('height', 'N/A')} cm
-- Cân nặng: {user_info.get('weight', 'N/A')} kg
-"""
-    user_name = user_info.get("name") if user_info else None
-    greeting = f"Chào {user_name}!" if user_name else "Chào bạn!"
+        # Chỉ ghi các trường có trong user_info (bucket_profile chỉ có trình độ + mục tiêu)
+        profile_lines = []
+        if "name" in user_info:
+            profile_lines.append(f"- Tên: {user_info.get('name') or 'N/A'}")
+        profile_lines.append(f"- Trình độ: {user_info.get('badmintonLevel', 'Chưa xác định')}")
+        if "badmintonExperience" in user_info:
+            profile_lines.append(f"- Kinh nghiệm: {user_info.get('badmintonExperience') or 'Chưa xác định'}")
+        profile_lines.append(f"- Mục tiêu: {goals_str if goals_str else 'Chưa xác định'}")
+        if "height" in user_info:
+            profile_lines.append(f"- Chiều cao: {user_info.get('height') or 'N/A'} cm")
+        if "weight" in user_info:
+            profile_lines.append(f"- Cân nặng: {user_info.get('weight') or 'N/A'} kg")
+        user_context = "\nThông tin người dùng:\n" + "\n".join(profile_lines) + "\n"
     prompt = f"""
 Bạn là chatbot tư vấn chuyên nghiệp về cầu lông và dinh dưỡng thể thao cho ứng dụng Badminton App.
 
@@ -336,7 +2693,7 @@ Danh sách món ăn hiện có:
 {meal_text}
 
 Hướng dẫn trả lời:
-- Bắt đầu đoạn chat bằng lời chào: "{greeting}" trong câu trả lời đầu tiên, sau đó trả lời trực tiếp các câu hỏi tiếp theo.
+- Không chào hỏi (ứng dụng đã tự thêm lời chào), trả lời trực tiếp vào câu hỏi.
 - Chỉ trả lời đúng ý câu hỏi, ngắn gọn và dễ hiểu
 - Nếu câu hỏi về bài tập, kế hoạch tập luyện, kỹ thuật cầu lông → tham khảo danh sách bài tập và đưa ra lời khuyên cụ thể
 - Nếu câu hỏi về dinh dưỡng, món ăn, calories → tham khảo danh sách món ăn và đưa ra gợi ý phù hợp
@@ -346,13 +2703,295 @@ Hướng dẫn trả lời:
 - Trả lời tự nhiên, thân thiện, không dùng dấu ** hay * để format
 - Nếu không biết câu trả lời, hãy thừa nhận và đề xuất liên hệ quản trị viên qua chat hỗ trợ
 
-Khách hàng hỏi: {question}
 """
+    return prompt
+
+def ask_gemini(question: str, training_list: list, meal_list: list, user_info: dict = None) -> str:
+    """
+    Gửi câu hỏi + dữ liệu bài tập và món ăn cho Gemini AI, trả về text tư vấn về cầu lông
+    """
+    with stage("prompt_build"):
+        prompt = build_chat_prompt(question, training_list, meal_list, user_info)
+    return gemini_reply(prompt)
+
+def gemini_reply(prompt: str) -> str:
+    """Gọi Gemini với prompt chat đã build, lỗi thì trả về CHAT_ERROR_MESSAGE"""
     try:
-        response = model.generate_content(prompt)
+        response = call_gemini(prompt, lane="chat")
         return response.text.strip()
+    except GeminiRateLimited:
+        raise
+    except Exception as e:
+        return f"{CHAT_ERROR_MESSAGE} ({str(e)})"
+
+def ask_gemini_stream(question: str, training_list: list, meal_list: list, user_info: dict = None):
+    """
+    Giống ask_gemini nhưng dùng streaming của Gemini, trả về iterator từng đoạn text
+    """
+    with stage("prompt_build"):
+        prompt = build_chat_prompt(question, training_list, meal_list, user_info)
+    return gemini_reply_stream(prompt)
+
+def gemini_reply_stream(prompt: str):
+    """
+    Giống gemini_reply nhưng stream, trả về iterator từng đoạn text.
+    Gọi Gemini (và lấy lượt ở governor) ngay lúc gọi hàm chứ không đợi tới khi
+    đọc stream, để GeminiRateLimited raise trước khi mở response → 429.
+    """
+    try:
+        response = call_gemini(prompt, lane="chat", stream=True)
+    except GeminiRateLimited:
+        raise
+    except Exception as e:
+        return iter([f"{CHAT_ERROR_MESSAGE} ({str(e)})"])
+    return _stream_text(response)
+
+def _stream_text(response):
+    try:
+        for chunk in response:
+            if chunk.text:
+                yield chunk.text
     except Exception as e:
-        return f"Xin lỗi, có lỗi xảy ra khi xử lý câu hỏi của bạn. Vui lòng thử lại sau. ({str(e)})"
+        yield f"{CHAT_ERROR_MESSAGE} ({str(e)})"
+
+class MarkdownStripper:
+    """
+    Bỏ dấu markdown (*, **, ```) theo từng chunk, kết quả giống hệt
+    reply.replace("**", "").replace("*", "").replace("```", "") trên toàn bộ text.
+    Giữ lại chuỗi ` ở cuối chunk vì có thể ghép với chunk sau thành ```
+    """
+
+    def __init__(self):
+        self._pending = ""
+
+    def feed(self, chunk: str) -> str:
+        text = self._pending + chunk.replace("*", "")
+        head = text.rstrip("`")
+        self._pending = text[len(head):]
+        return head.replace("```", "")
+
+    def flush(self) -> str:
+        text, self._pending = self._pending, ""
+        return text.replace("```", "")
+
+# ========== CHAT SESSIONS ==========
+
+CHAT_SESSION_SIZE = int(os.getenv("CHAT_SESSION_SIZE", "1000"))
+CHAT_SESSION_TTL_SECONDS = int(os.getenv("CHAT_SESSION_TTL_SECONDS", "3600"))
+CHAT_SESSION_MONGO = os.getenv("CHAT_SESSION_MONGO", "0") == "1"
+# Ngân sách token cho các lượt gần nhất (nguyên văn) và phần tóm tắt lượt cũ
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "800"))
+CHAT_SUMMARY_TOKEN_BUDGET = int(os.getenv("CHAT_SUMMARY_TOKEN_BUDGET", "300"))
+# Số lần ghi lại khi worker khác vừa cập nhật cùng phiên
+CHAT_SESSION_WRITE_RETRIES = 3
+
+
+def shorten(text, limit):
+    text = " ".join(str(text).split())
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(" ", 1)[0] + "…"
+
+
+def summarize_turn(question, answer):
+    """Tóm tắt trích xuất 1 lượt: câu hỏi + câu đầu của câu trả lời (không gọi Gemini)"""
+    first_sentence = re.split(r"(?<=[.!?])\s", " ".join(answer.split()), maxsplit=1)[0]
+    return f"- Khách hỏi: {shorten(question, 160)} → Đã trả lời: {shorten(first_sentence, 200)}"
+
+
+class ChatSession:
+    """
+    1 phiên chat: prefix cố định (build 1 lần) + tóm tắt các lượt cũ + các lượt gần nhất.
+    Lượt cũ vượt CHAT_HISTORY_TOKEN_BUDGET được gộp vào tóm tắt, tóm tắt vượt
+    CHAT_SUMMARY_TOKEN_BUDGET thì bỏ dòng cũ nhất → prompt mỗi lượt không phình theo lịch sử
+    """
+
+    def __init__(self, key, prefix=None, catalog_version=None, summary=None, turns=None, revision=0):
+        self.key = key
+        self.prefix = prefix
+        self.catalog_version = catalog_version
+        self.summary = summary or []
+        self.turns = turns or []
+        # Số lần đã ghi vào Mongo, dùng để cập nhật có điều kiện (0 = chưa có document)
+        self.revision = revision
+
+    @property
+    def session_id(self):
+        """Id trả cho client (key = "<userId>|<sessionId>")"""
+        return self.key.split("|", 1)[1]
+
+    def build_prompt(self, question):
+        parts = [self.prefix]
+        if self.summary:
+            parts.append("Tóm tắt các lượt trò chuyện trước:\n" + "\n".join(self.summary) + "\n\n")
+        if self.turns:
+            history = "\n".join(f"Khách hàng: {q}\nChatbot: {a}" for q, a in self.turns)
+            parts.append(f"Các lượt trò chuyện gần đây:\n{history}\n\n")
+        parts.append(f"Khách hàng hỏi: {question}\n")
+        return "".join(parts)
+
+    def add_turn(self, question, answer):
+        self.turns.append([question, answer])
+
+        # Giữ nguyên văn ít nhất lượt mới nhất
+        while len(self.turns) > 1 and sum(estimate_tokens(q) + estimate_tokens(a) for q, a in self.turns) > CHAT_HISTORY_TOKEN_BUDGET:
+            q, a = self.turns.pop(0)
+            self.summary.append(summarize_turn(q, a))
+
+        while len(self.summary) > 1 and estimate_tokens("\n".join(self.summary)) > CHAT_SUMMARY_TOKEN_BUDGET:
+            self.summary.pop(0)
+
+    def to_doc(self):
+        return {
+            "prefix": self.prefix,
+            "catalogVersion": self.catalog_version,
+            "summary": self.summary,
+            "turns": self.turns,
+        }
+
+    def copy(self):
+        return ChatSession(
+            self.key, self.prefix, self.catalog_version,
+            list(self.summary), [list(t) for t in self.turns], self.revision
+        )
+
+    @classmethod
+    def from_doc(cls, key, doc):
+        return cls(
+            key, doc.get("prefix"), doc.get("catalogVersion"), doc.get("summary"), doc.get("turns"),
+            doc.get("revision", 0)
+        )
+
+
+class ChatSessionStore:
+    """
+    Lưu phiên chat: LRU + TTL trong process, có thể lưu vào collection Mongo
+    (TTL index, CHAT_SESSION_MONGO=1) để các worker gunicorn dùng chung.
+
+    Khi có Mongo thì Mongo là nguồn dữ liệu chính: luôn đọc từ Mongo, ghi bằng
+    update có điều kiện theo `revision`; LRU chỉ dùng tạm khi Mongo lỗi
+    """
+
+    def __init__(self, max_size=CHAT_SESSION_SIZE, ttl=CHAT_SESSION_TTL_SECONDS, collection=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.collection = collection
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._indexed = False
+
+    def open(self, session_id, user_info, question):
+        """
+        Lấy phiên chat (tạo mới nếu chưa có). Prefix chỉ build khi phiên mới
+        hoặc catalog đã đổi version; phần trích catalog lấy theo câu hỏi đầu tiên.
+
+        Session id do server cấp (ngẫu nhiên): id client gửi lên không tồn tại
+        (vd "new") thì mở phiên mới với id mới, trả lại qua `session.session_id`.
+        Tránh việc các client ẩn danh tự đặt trùng id và dùng chung lịch sử.
+        """
+        user_id = user_info["_id"] if user_info else "anonymous"
+        version = catalog.version
+
+        session = self.get(f"{user_id}|{session_id}")
+        if session is None:
+            session = ChatSession(f"{user_id}|{uuid.uuid4().hex}")
+        if session.prefix is None or session.catalog_version != version:
+            with stage("retrieval"):
+                training_list = get_training_list(question)
+                meal_list = get_meal_list(question)
+            with stage("prompt_build"):
+                session.prefix = build_chat_prefix(training_list, meal_list, user_info)
+            session.catalog_version = version
+            metrics.inc("chat_session_prefix_builds_total")
+        return session
+
+    def get(self, key):
+        if self.collection is not None:
+            try:
+                return self._load(key)
+            except Exception as e:
+                # Mongo lỗi tạm thời → dùng tạm bản trong process
+                print(f"Chat session read error: {e}")
+        return self._get_local(key)
+
+    def _get_local(self, key):
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires_at, session = item
+            if expires_at <= now:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return session.copy()
+
+    def _load(self, key):
+        doc = self.collection.find_one({"_id": key})
+        if not doc:
+            return None
+        if doc["expiresAt"].replace(tzinfo=timezone.utc) <= datetime.now(timezone.utc):
+            # Hết hạn nhưng TTL index chưa xóa: phiên mới, giữ revision để ghi đè được
+            return ChatSession(key, revision=doc.get("revision", 0))
+        return ChatSession.from_doc(key, doc)
+
+    def record(self, session, question, answer):
+        """Thêm 1 lượt hỏi/đáp rồi lưu phiên"""
+        if self.collection is None:
+            session.add_turn(question, answer)
+            self._store(session)
+            return
+
+        try:
+            if not self._indexed:
+                self.collection.create_index("expiresAt", expireAfterSeconds=0)
+                self._indexed = True
+            for _ in range(CHAT_SESSION_WRITE_RETRIES):
+                updated = session.copy()
+                updated.add_turn(question, answer)
+                if self._write(updated):
+                    self._store(updated)
+                    return
+                # Worker khác vừa ghi phiên này → đọc lại rồi thêm lượt lên bản mới nhất
+                metrics.inc("chat_session_conflicts_total")
+                latest = self._load(session.key) or ChatSession(session.key)
+                latest.prefix, latest.catalog_version = session.prefix, session.catalog_version
+                session = latest
+            print(f"Chat session write conflict: {session.key}")
+        except Exception as e:
+            print(f"Chat session write error: {e}")
+            session.add_turn(question, answer)
+            self._store(session)
+
+    def _write(self, session):
+        """Ghi phiên nếu document trong Mongo vẫn ở đúng revision đã đọc"""
+        doc = session.to_doc()
+        doc["expiresAt"] = datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+        if session.revision:
+            query = {"_id": session.key, "revision": session.revision}
+        else:
+            query = {"_id": session.key, "revision": {"$exists": False}}
+        try:
+            result = self.collection.update_one(query, {"$set": doc, "$inc": {"revision": 1}}, upsert=True)
+        except DuplicateKeyError:
+            # Upsert trùng _id: document đã có với revision khác
+            return False
+        if not result.matched_count and result.upserted_id is None:
+            return False
+        session.revision += 1
+        return True
+
+    def _store(self, session):
+        with self._lock:
+            self._items[session.key] = (time.monotonic() + self.ttl, session)
+            self._items.move_to_end(session.key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+chat_sessions = ChatSessionStore(collection=db["chatsessions"] if CHAT_SESSION_MONGO else None)
+
 
 @app.route("/chat", methods=["POST"])
 def chat():
@@ -360,7 +2999,9 @@ def chat():
     Endpoint chat với AI chatbot
     Body: {
         "message": "Câu hỏi của người dùng",
-        "userId": "user_id (optional)" - để lấy thông tin người dùng
+        "userId": "user_id (optional)" - để lấy thông tin người dùng,
+        "sessionId": "session_id (optional)" - giữ ngữ cảnh hội thoại nhiều lượt:
+            gửi "new" để mở phiên, các lượt sau gửi lại sessionId server trả về
     }
     """
     data = request.get_json()
@@ -369,36 +3010,435 @@ def chat():
     if not question:
         return jsonify({"reply": "Xin lỗi, bạn chưa nhập câu hỏi."}), 400
     
-    user_info = None
-    user_id = data.get("userId")
-    if user_id:
+    if request.accept_mimetypes.best_match(["application/json", "text/event-stream"]) == "text/event-stream":
+        return chat_stream()
+
+    with stage("user_lookup"):
+        user_info = get_chat_user(data.get("userId"))
+
+    session = None
+    if data.get("sessionId"):
+        with stage("chat_session"):
+            session = chat_sessions.open(str(data["sessionId"]), user_info, question)
+    # Lượt sau của phiên phụ thuộc lịch sử → không dùng cache câu trả lời, không chào lại
+    first_turn = session is None or not session.turns
+
+    # Câu hỏi gần giống đã có câu trả lời cho cùng nhóm user → khỏi gọi Gemini
+    reply_clean = None
+    if first_turn:
+        bucket = chat_bucket(user_info, catalog.version)
+        with stage("chat_cache"):
+            reply_clean = chat_cache.get(question, bucket)
+        metrics.inc("cache_requests_total", cache="chat", result="hit" if reply_clean is not None else "miss")
+
+    failed = False
+    if reply_clean is None:
         try:
-            user = users.find_one({"_id": ObjectId(user_id)}, {"passwordHash": 0})
-            if user:
-                user["_id"] = str(user["_id"])
-                user_info = user
-        except Exception as e:
-            print(f"Error getting user info: {e}")
+            if session is not None:
+                with stage("prompt_build"):
+                    prompt = session.build_prompt(question)
+                reply = gemini_reply(prompt)
+            else:
+                with stage("retrieval"):
+                    training_list = get_training_list(question)
+                    meal_list = get_meal_list(question)
+                # Câu trả lời sẽ dùng chung cho cả bucket → prompt chỉ có trình độ + mục tiêu
+                reply = ask_gemini(question, training_list, meal_list, bucket_profile(user_info))
+        except GeminiRateLimited as e:
+            return rate_limited_response(e)
 
-    training_list = get_training_list()
-    meal_list = get_meal_list()
-    
-    reply = ask_gemini(question, training_list, meal_list, user_info)
+        reply_clean = reply.replace("**", "").replace("*", "").replace("```", "")
 
-    reply_clean = reply.replace("**", "").replace("*", "").replace("```", "")
-    
-    return jsonify({"reply": reply_clean})
+        failed = reply.startswith(CHAT_ERROR_MESSAGE)
+        # Prompt của phiên có đủ hồ sơ user → không đưa vào cache dùng chung
+        if not failed and session is None:
+            chat_cache.set(question, bucket, reply_clean)
+
+    if session is None:
+        return jsonify({"reply": f"{chat_greeting(user_info)} {reply_clean}"})
+
+    if not failed:
+        chat_sessions.record(session, question, reply_clean)
+    greeting = f"{chat_greeting(user_info)} " if first_turn else ""
+    return jsonify({"reply": f"{greeting}{reply_clean}", "sessionId": session.session_id})
+
+def rate_limited_response(e):
+    """429 + Retry-After khi Gemini quá tải"""
+    return jsonify({
+        "reply": "Hệ thống đang quá tải, bạn vui lòng thử lại sau ít phút.",
+        "retryAfter": e.retry_after
+    }), 429, {"Retry-After": str(e.retry_after)}
+
+def get_chat_user(user_id):
+    """Lấy thông tin người dùng cho chatbot, lỗi thì bỏ qua"""
+    if not user_id:
+        return None
+    try:
+        user = users.find_one({"_id": ObjectId(user_id)}, {"passwordHash": 0})
+        if user:
+            user["_id"] = str(user["_id"])
+            return user
+    except Exception as e:
+        print(f"Error getting user info: {e}")
+    return None
+
+def sse_event(data: dict, event: str = None) -> str:
+    lines = f"event: {event}\n" if event else ""
+    return lines + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    """
+    Chat dạng Server-Sent Events (cũng dùng được qua /chat với Accept: text/event-stream)
+    Body: giống /chat
+    Events:
+        data: {"delta": "..."}             - từng đoạn câu trả lời (đã bỏ markdown)
+        event: done, data: {"reply": "..."} - câu trả lời đầy đủ
+    """
+    data = request.get_json()
+    question = data.get("message", "").strip()
+
+    if not question:
+        return jsonify({"reply": "Xin lỗi, bạn chưa nhập câu hỏi."}), 400
+
+    with stage("user_lookup"):
+        user_info = get_chat_user(data.get("userId"))
+
+    session_id = data.get("sessionId")
+    session = None
+    if session_id:
+        with stage("chat_session"):
+            session = chat_sessions.open(str(session_id), user_info, question)
+    first_turn = session is None or not session.turns
+    greeting = f"{chat_greeting(user_info)} " if first_turn else ""
+
+    def done_event(reply):
+        payload = {"reply": f"{greeting}{reply}"}
+        if session is not None:
+            payload["sessionId"] = session.session_id
+        return sse_event(payload, event="done")
+
+    cached_reply = None
+    if first_turn:
+        bucket = chat_bucket(user_info, catalog.version)
+        with stage("chat_cache"):
+            cached_reply = chat_cache.get(question, bucket)
+        metrics.inc("cache_requests_total", cache="chat", result="hit" if cached_reply is not None else "miss")
+
+    if cached_reply is None:
+        # Lấy lượt Gemini trước khi mở stream: hết ngân sách / hàng đợi đầy → 429
+        try:
+            if session is not None:
+                with stage("prompt_build"):
+                    prompt = session.build_prompt(question)
+                chunks = gemini_reply_stream(prompt)
+            else:
+                with stage("retrieval"):
+                    training_list = get_training_list(question)
+                    meal_list = get_meal_list(question)
+                chunks = ask_gemini_stream(question, training_list, meal_list, bucket_profile(user_info))
+        except GeminiRateLimited as e:
+            return rate_limited_response(e)
+
+    def generate():
+        if greeting:
+            yield sse_event({"delta": greeting})
+
+        if cached_reply is not None:
+            if session is not None:
+                chat_sessions.record(session, question, cached_reply)
+            yield sse_event({"delta": cached_reply})
+            yield done_event(cached_reply)
+            return
 
-def calculate_distance(lat1, lon1, lat2, lon2):
-    """Tính khoảng cách giữa 2 điểm (km)"""
+        stripper = MarkdownStripper()
+        parts = []
+        started = False
+        for chunk in chunks:
+            text = stripper.feed(chunk)
+            if not started:
+                text = text.lstrip()
+                started = bool(text)
+            if text:
+                parts.append(text)
+                yield sse_event({"delta": text})
+        text = stripper.flush()
+        if text:
+            parts.append(text)
+            yield sse_event({"delta": text})
+
+        reply_clean = "".join(parts).strip()
+        if CHAT_ERROR_MESSAGE not in reply_clean:
+            if session is None:
+                chat_cache.set(question, bucket, reply_clean)
+            if session is not None:
+                chat_sessions.record(session, question, reply_clean)
+        yield done_event(reply_clean)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+HERE_DISCOVER_URL = os.getenv("HERE_DISCOVER_URL", "https://discover.search.hereapi.com/v1/discover")
+
+def parse_here_place(place):
+    """Chuyển 1 item của HERE Discover thành dict sân (chưa có distance), None nếu thiếu tọa độ"""
+    position = place.get('position', {})
+    court_lat = position.get('lat')
+    court_lng = position.get('lng')
+
+    if not court_lat or not court_lng:
+        return None
+
+    address = place.get('address', {})
+    full_address = address.get('label', 'N/A')
+
+    # Lấy thông tin liên hệ
+    contacts = place.get('contacts', [])
+    phone = None
+    if contacts and contacts[0].get('phone'):
+        phone = contacts[0]['phone'][0].get('value')
+
+    # Giờ mở cửa
+    opening_hours = place.get('openingHours', [])
+    is_open = opening_hours[0].get('isOpen') if opening_hours else None
+
+    return {
+        'id': place.get('id'),
+        'name': place.get('title', 'Sân cầu lông'),
+        'address': full_address,
+        'latitude': court_lat,
+        'longitude': court_lng,
+        'phone': phone,
+        'isOpen': is_open
+    }
+
+# ========== OUTBOUND HTTP CLIENT ==========
+
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "5"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+
+_http_session = None
+_http_session_pid = None
+_http_session_lock = threading.Lock()
+
+def get_http_session():
+    """
+    requests.Session dùng chung (keep-alive, connection pool), tạo lại sau fork.
+    Retry có giới hạn với backoff + jitter cho lỗi kết nối và 5xx. Không retry 429 và
+    không chờ theo Retry-After (không có giới hạn, giữ worker quá HTTP_READ_TIMEOUT):
+    429 trả về ngay để circuit breaker ghi nhận.
+    """
+    global _http_session, _http_session_pid
+    pid = os.getpid()
+    if _http_session is not None and _http_session_pid == pid:
+        return _http_session
+
+    with _http_session_lock:
+        if _http_session is None or _http_session_pid != pid:
+            retry = Retry(
+                total=HTTP_RETRIES,
+                backoff_factor=0.2,
+                backoff_jitter=0.2,
+                status_forcelist=(500, 502, 503, 504),
+                allowed_methods=frozenset(["GET"]),
+                respect_retry_after_header=False,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+            _http_session_pid = pid
+    return _http_session
+
+here_breaker = CircuitBreaker(
+    "here",
+    failure_threshold=int(os.getenv("HERE_BREAKER_THRESHOLD", "5")),
+    reset_timeout=float(os.getenv("HERE_BREAKER_RESET_SECONDS", "30")),
+)
+
+def redact_url(text):
+    """Bỏ query string khỏi URL trong message lỗi (query của HERE chứa apiKey)"""
+    return re.sub(r"\?\S*", "", str(text))
+
+def here_get(params):
+    """GET HERE Discover qua session chung, có timeout và circuit breaker"""
+    metrics.inc("here_requests_total")
+    if not here_breaker.allow():
+        metrics.inc("here_rejected_total", reason="circuit_open")
+        raise ServiceUnavailable("HERE API tạm thời không khả dụng")
+
+    try:
+        with stage("here"):
+            response = get_http_session().get(
+                HERE_DISCOVER_URL,
+                params=params,
+                timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+            )
+            if response.status_code >= 400:
+                # Không dùng raise_for_status(): message của nó chứa URL đầy đủ kèm apiKey
+                raise requests.HTTPError(f"HERE API HTTP {response.status_code}", response=response)
+            data = response.json()
+    except Exception:
+        here_breaker.record_failure()
+        metrics.inc("here_errors_total")
+        raise
+
+    here_breaker.record_success()
+    return data
+
+def fetch_here_courts(latitude, longitude, api_key):
+    """
+    Gọi HERE Discover API với 2 từ khóa song song ('badminton court' và 'badminton'),
+    gộp kết quả và bỏ trùng theo id. Raise nếu cả 2 đều lỗi.
+    """
+    base_params = {
+        'at': f'{latitude},{longitude}',
+        'limit': 10,  # Lấy 10 để có đủ dữ liệu, sau đó filter ra 5
+        'apiKey': api_key,
+        'lang': 'vi-VN'
+    }
+    queries = ['badminton court', 'badminton']
+
+    with ThreadPoolExecutor(max_workers=len(queries), thread_name_prefix="here") as pool:
+        futures = [pool.submit(here_get, dict(base_params, q=q)) for q in queries]
+
+        results = []
+        errors = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                errors.append(e)
+
+    if not results:
+        raise errors[0]
+
+    court_list = []
+    seen = set()
+    for data in results:
+        for place in data.get('items', []):
+            court = parse_here_place(place)
+            if not court or court['id'] in seen:
+                continue
+            seen.add(court['id'])
+            court_list.append(court)
+    return court_list
+
+def nearest_courts(latitude, longitude, court_list, k=5):
+    """
+    Tính khoảng cách (haversine, km) cho cả danh sách 1 lượt rồi lấy TOP k gần nhất.
+    cos/radians của điểm gốc chỉ tính 1 lần.
+    """
     R = 6371
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
-    a = (math.sin(dlat / 2) ** 2 +
-         math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) *
-         math.sin(dlon / 2) ** 2)
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return round(R * c, 2)
+    lat1 = math.radians(latitude)
+    lon1 = math.radians(longitude)
+    cos_lat1 = math.cos(lat1)
+
+    results = []
+    for c in court_list:
+        lat2 = math.radians(c['latitude'])
+        dlat = lat2 - lat1
+        dlon = math.radians(c['longitude']) - lon1
+        a = math.sin(dlat / 2) ** 2 + cos_lat1 * math.cos(lat2) * math.sin(dlon / 2) ** 2
+        distance = round(R * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a)), 2)
+        results.append({
+            'id': c['id'],
+            'name': c['name'],
+            'address': c['address'],
+            'latitude': c['latitude'],
+            'longitude': c['longitude'],
+            'distance': distance,
+            'phone': c.get('phone'),
+            'isOpen': c.get('isOpen')
+        })
+
+    # Sắp xếp theo khoảng cách và lấy TOP k
+    results.sort(key=lambda x: x['distance'])
+    return results[:k]
+
+# ========== COURT TILE CACHE ==========
+
+COURT_TILE_DEGREES = float(os.getenv("COURT_TILE_DEGREES", "0.05"))  # ~5.5 km
+COURT_CACHE_TTL_SECONDS = int(os.getenv("COURT_CACHE_TTL_SECONDS", "21600"))
+
+def court_tile(latitude, longitude):
+    return f"{math.floor(latitude / COURT_TILE_DEGREES)}:{math.floor(longitude / COURT_TILE_DEGREES)}"
+
+def neighbour_tiles(latitude, longitude):
+    """Tile chứa vị trí + 8 tile xung quanh"""
+    return [
+        court_tile(latitude + dy * COURT_TILE_DEGREES, longitude + dx * COURT_TILE_DEGREES)
+        for dy in (-1, 0, 1)
+        for dx in (-1, 0, 1)
+    ]
+
+class CourtTileCache:
+    """
+    Cache kết quả HERE theo ô lưới (tile) trong Mongo.
+
+    - courttiles: {_id: tile, placeIds: [...], expiresAt} - mỗi tile đã gọi HERE
+    - courts: mỗi sân 1 document (đọc theo placeIds của tile), có expiresAt
+    Cả 2 collection đều có TTL index. Chỉ tile chưa có cache mới gọi HERE.
+    """
+
+    def __init__(self, tiles_collection, courts_collection, ttl=COURT_CACHE_TTL_SECONDS):
+        self.tiles = tiles_collection
+        self.courts = courts_collection
+        self.ttl = ttl
+        self._indexed = False
+
+    def _ensure_indexes(self):
+        if self._indexed:
+            return
+        self.tiles.create_index("expiresAt", expireAfterSeconds=0)
+        self.courts.create_index("expiresAt", expireAfterSeconds=0)
+        self._indexed = True
+
+    def get(self, latitude, longitude):
+        """Danh sách sân từ các tile quanh vị trí, None nếu tile của user chưa có cache"""
+        now = datetime.now(timezone.utc)
+        tile_docs = list(self.tiles.find({
+            "_id": {"$in": neighbour_tiles(latitude, longitude)},
+            "expiresAt": {"$gt": now}
+        }))
+        if not any(t["_id"] == court_tile(latitude, longitude) for t in tile_docs):
+            return None
+
+        place_ids = list({pid for t in tile_docs for pid in t.get("placeIds", [])})
+        if not place_ids:
+            return []
+        return list(self.courts.find({"_id": {"$in": place_ids}, "expiresAt": {"$gt": now}}))
+
+    def put(self, latitude, longitude, court_list):
+        """Lưu kết quả HERE của tile chứa vị trí (kể cả khi rỗng)"""
+        self._ensure_indexes()
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+
+        ops = []
+        for c in court_list:
+            if not c.get('id'):
+                continue
+            doc = dict(c)
+            doc["_id"] = c["id"]
+            doc["expiresAt"] = expires_at
+            ops.append(ReplaceOne({"_id": doc["_id"]}, doc, upsert=True))
+        if ops:
+            self.courts.bulk_write(ops, ordered=False)
+
+        self.tiles.replace_one(
+            {"_id": court_tile(latitude, longitude)},
+            {"placeIds": [c["id"] for c in court_list if c.get("id")], "expiresAt": expires_at},
+            upsert=True,
+        )
+
+court_cache = CourtTileCache(courttiles, courts)
 
 def search_nearby_courts(latitude, longitude):
     """
@@ -415,70 +3455,31 @@ def search_nearby_courts(latitude, longitude):
     
     if not api_key:
         return {"error": "Chưa cấu hình HERE API Key"}
-    
-    # HERE Discover API
-    url = "https://discover.search.hereapi.com/v1/discover"
-    
-    params = {
-        'at': f'{latitude},{longitude}',
-        'q': 'badminton court',
-        'limit': 10,  # Lấy 10 để có đủ dữ liệu, sau đó filter ra 5
-        'apiKey': api_key,
-        'lang': 'vi-VN'
-    }
-    
+
+    # 1) Tile đã có cache → không gọi HERE
     try:
-        response = requests.get(url, params=params)
-        data = response.json()
-        
-        if 'items' not in data or len(data['items']) == 0:
-            # Thử keyword rộng hơn
-            params['q'] = 'badminton'
-            response = requests.get(url, params=params)
-            data = response.json()
-        
-        courts = []
-        for place in data.get('items', []):
-            position = place.get('position', {})
-            court_lat = position.get('lat')
-            court_lng = position.get('lng')
-            
-            if not court_lat or not court_lng:
-                continue
-            
-            distance = calculate_distance(latitude, longitude, court_lat, court_lng)
-            
-            address = place.get('address', {})
-            full_address = address.get('label', 'N/A')
-            
-            # Lấy thông tin liên hệ
-            contacts = place.get('contacts', [])
-            phone = None
-            if contacts and contacts[0].get('phone'):
-                phone = contacts[0]['phone'][0].get('value')
-            
-            # Giờ mở cửa
-            opening_hours = place.get('openingHours', [])
-            is_open = opening_hours[0].get('isOpen') if opening_hours else None
-            
-            courts.append({
-                'id': place.get('id'),
-                'name': place.get('title', 'Sân cầu lông'),
-                'address': full_address,
-                'latitude': court_lat,
-                'longitude': court_lng,
-                'distance': distance,
-                'phone': phone,
-                'isOpen': is_open
-            })
-        
-        # Sắp xếp theo khoảng cách và lấy TOP 5
-        courts.sort(key=lambda x: x['distance'])
-        return courts[:5]
-        
+        with stage("court_cache"):
+            cached = court_cache.get(latitude, longitude)
+    except Exception as e:
+        print(f"Court cache read error: {e}")
+        cached = None
+    metrics.inc("cache_requests_total", cache="court", result="hit" if cached is not None else "miss")
+    if cached is not None:
+        return nearest_courts(latitude, longitude, cached)
+
+    # 2) Tile chưa có cache → gọi HERE rồi lưu lại
+    try:
+        court_list = fetch_here_courts(latitude, longitude, api_key)
+    except Exception as e:
+        print(f"HERE API Error: {redact_url(e)}")
+        return {"error": "Không thể tìm sân lúc này, vui lòng thử lại sau"}
+
+    try:
+        court_cache.put(latitude, longitude, court_list)
     except Exception as e:
-        print(f"HERE API Error: {e}")
-        return {"error": f"Lỗi khi tìm kiếm: {str(e)}"}
+        print(f"Court cache write error: {e}")
+
+    return nearest_courts(latitude, longitude, court_list)
 
 # ========== ENDPOINT ==========
 
@@ -543,6 +3544,144 @@ def nearby_courts():
     })
 
 
-if __name__ == "__main__":
+# ========== WARMUP / HEALTH ==========
+
+READY_PING_TIMEOUT = float(os.getenv("READY_PING_TIMEOUT", "2"))
+
+_warm_pid = None
+_warming_pid = None
+_warmup_error = None
+_warmup_thread = None
+# Chỉ giữ trong vài phép gán, không giữ khi gọi Mongo / import model: /readyz không bị
+# chặn, và không deadlock dưới gevent (lock tạo trước monkey patch khi preload)
+_warmup_state_lock = threading.Lock()
+_warmup_thread_lock = threading.Lock()
+
+def warmup():
+    """
+    Làm nóng process hiện tại: mở kết nối Mongo, load catalog + index BM25,
+    tạo model Gemini và HTTP session. Chạy sau fork (gunicorn post_worker_init
+    khi APP_WARMUP=1) hoặc nền khi /readyz được gọi lần đầu.
+
+    Returns:
+        True nếu process đã nóng, False nếu lỗi hoặc đang có lần warmup khác chạy
+    """
+    global _warm_pid, _warming_pid, _warmup_error
+    pid = os.getpid()
+    with _warmup_state_lock:
+        if _warm_pid == pid:
+            return True
+        if _warming_pid == pid:
+            return False
+        _warming_pid = pid
+
+    start = time.perf_counter()
+    try:
+        mongo.client.admin.command("ping")
+        snapshot = catalog.get()
+        snapshot.training_index()
+        snapshot.meal_index()
+        snapshot.goal_buckets()
+        get_model()
+        get_http_session()
+
+        elapsed = time.perf_counter() - start
+        metrics.observe("warmup_duration_seconds", elapsed)
+        print(f"Warmup done in {elapsed:.2f}s (pid {pid})")
+        _warm_pid = pid
+        _warmup_error = None
+        return True
+    except Exception as e:
+        _warmup_error = str(e)
+        print(f"Warmup error: {e}")
+        return False
+    finally:
+        with _warmup_state_lock:
+            _warming_pid = None
+
+def start_warmup():
+    """Chạy warmup trong thread nền (nếu chưa chạy)"""
+    global _warmup_thread
+    with _warmup_thread_lock:
+        if _warmup_thread is not None and _warmup_thread.is_alive():
+            return
+        _warmup_thread = threading.Thread(target=warmup, name="warmup", daemon=True)
+        _warmup_thread.start()
+
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """Liveness: process còn phục vụ request, không chạm tới Mongo / Gemini"""
+    return jsonify({"status": "ok"})
+
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    """
+    Readiness: 200 khi worker đã làm nóng và Mongo phản hồi.
+    Worker chưa nóng trả 503 và tự làm nóng nền, router thử lại sau.
+    """
+    if _warm_pid != os.getpid():
+        start_warmup()
+        return jsonify({"status": "warming", "error": _warmup_error}), 503
+
+    try:
+        with mongo_timeout(READY_PING_TIMEOUT):
+            mongo.client.admin.command("ping")
+    except Exception as e:
+        return jsonify({"status": "unavailable", "error": str(e)}), 503
+
+    return jsonify({"status": "ready", "catalogVersion": catalog.version})
+
+
+# ========== METRICS ENDPOINT ==========
+
+metrics.gauge("catalog_version", lambda: catalog._snapshot.version if catalog._snapshot else 0)
+metrics.gauge("circuit_open", lambda: {
+    (("name", b.name),): int(b.is_open) for b in (gemini_breaker, here_breaker)
+})
+metrics.gauge("cache_entries", lambda: {
+    (("cache", "plan"),): len(plan_cache._items),
+    (("cache", "chat"),): len(chat_cache._entries),
+})
+metrics.gauge("chat_cache_hit_ratio", lambda: chat_cache.stats()["hitRate"])
+metrics.gauge("gemini_queue_depth", lambda: {
+    (("lane", lane),): gemini_governor.depth(lane) for lane in GEMINI_LANES
+})
+metrics.gauge("gemini_inflight_calls", lambda: len(gemini_inflight._calls))
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Metrics dạng text Prometheus"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app")
+    sub = parser.add_subparsers(dest="command")
+
+    pre = sub.add_parser("precompute-plans", help="Sinh trước lộ trình cho toàn bộ user")
+    pre.add_argument("--concurrency", type=int, default=4, help="Số nhóm sinh song song")
+    pre.add_argument("--engine", choices=["gemini", "local"])
+    pre.add_argument("--mode", choices=["single", "split"])
+    pre.add_argument("--limit", type=int, default=0, help="Số user tối đa (0 = tất cả)")
+    pre.add_argument("--force", action="store_true", help="Sinh lại cả cho user đã có lộ trình hợp lệ")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "precompute-plans":
+        options = {k: v for k, v in (("engine", args.engine), ("mode", args.mode), ("regenerate", args.force)) if v}
+        stats = precompute_plans(args.concurrency, options, args.limit or None)
+        print(json.dumps(stats, ensure_ascii=False))
+        return
+
+    if os.getenv("APP_WARMUP", "0") == "1":
+        warmup()
+
     app.debug = True
     app.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Hàm dùng chung cho các script benchmark: chạy tải đồng thời và tính percentile.
+"""
+import socket
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[k]
+
+
+def drive(fn, requests, concurrency):
+    """
+    Gọi fn(i) cho i = 0..requests-1 với `concurrency` luồng song song.
+    fn trả về status code; trả về (danh sách (giây, status), tổng thời gian)
+    """
+    def one(i):
+        start = time.perf_counter()
+        try:
+            status = fn(i)
+        except Exception:
+            status = 0
+        return time.perf_counter() - start, status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    return results, time.perf_counter() - start
+
+
+def summarize(results, elapsed):
+    """Throughput + p50/p95/p99 (ms) của các request thành công (status < 400)"""
+    latencies = [lat for lat, status in results if 0 < status < 400]
+
+    def ms(value):
+        return round(value * 1000, 2) if value is not None else None
+
+    return {
+        "requests": len(results),
+        "ok": len(latencies),
+        "errors": len(results) - len(latencies),
+        "elapsed": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50": ms(percentile(latencies, 50)),
+        "p95": ms(percentile(latencies, 95)),
+        "p99": ms(percentile(latencies, 99)),
+        "mean": ms(statistics.mean(latencies)) if latencies else None,
+    }
@@ -0,0 +1,170 @@
+"""
+Benchmark tải cho /chat, /recommend/training-plan/<id> và /api/nearby-courts.
+
+App chạy trong tiến trình (werkzeug, đa luồng) với Mongo giả (mongomock) hoặc
+mongod local, Gemini giả và HERE giả. Kết quả lưu JSON để so sánh giữa các lần chạy:
+
+    python -m benchmarks.load --concurrency 1,8,32 --requests 200
+    python -m benchmarks.load --mongo-uri mongodb://localhost:27017/bench
+    python -m benchmarks.load --compare benchmarks/results/<cũ>.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import threading
+from datetime import datetime, timezone
+
+import requests
+from werkzeug.serving import make_server
+
+from benchmarks.common import drive, summarize
+from benchmarks.stubs import FakeHereServer, install_stubs, load_app
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("chat", "plan", "courts")
+
+QUESTIONS = [
+    "Làm sao để đập cầu mạnh hơn?",
+    "Cách cầm vợt đúng cho người mới?",
+    "Nên ăn gì trước khi tập cầu lông?",
+    "Bài tập nào giúp di chuyển nhanh hơn trên sân?",
+    "Làm sao để tránh chấn thương cổ tay?",
+    "Tập bao nhiêu buổi một tuần là hợp lý?",
+]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except Exception:
+        return None
+
+
+def make_scenario(name, base_url, user_ids, seed):
+    """Trả về hàm fn(i) → status code cho từng kịch bản"""
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=256))
+    rng = random.Random(seed)
+    coords = [(10.7 + rng.random() * 0.2, 106.6 + rng.random() * 0.2) for _ in range(64)]
+
+    def chat(i):
+        body = {"message": f"{QUESTIONS[i % len(QUESTIONS)]} (lần {i})", "userId": user_ids[i % len(user_ids)]}
+        return session.post(f"{base_url}/chat", json=body, timeout=300).status_code
+
+    def plan(i):
+        return session.get(f"{base_url}/recommend/training-plan/{user_ids[i % len(user_ids)]}", timeout=300).status_code
+
+    def courts(i):
+        lat, lon = coords[i % len(coords)]
+        return session.post(f"{base_url}/api/nearby-courts", json={"latitude": lat, "longitude": lon}, timeout=60).status_code
+
+    return {"chat": chat, "plan": plan, "courts": courts}[name]
+
+
+def compare(old, new):
+    """In chênh lệch throughput / p95 so với lần chạy trước"""
+    previous = {(r["scenario"], r["concurrency"]): r for r in old.get("results", [])}
+    for r in new["results"]:
+        before = previous.get((r["scenario"], r["concurrency"]))
+        if not before:
+            continue
+
+        def delta(key):
+            if not before.get(key) or r.get(key) is None:
+                return "n/a"
+            return f"{(r[key] - before[key]) / before[key] * 100:+.1f}%"
+
+        print(f"{r['scenario']:>7} c={r['concurrency']:<4} "
+              f"throughput {before['throughput']} → {r['throughput']} ({delta('throughput')})  "
+              f"p95 {before['p95']} → {r['p95']} ms ({delta('p95')})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.load")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--concurrency", default="1,8,32", help="Các mức đồng thời, cách nhau dấu phẩy")
+    parser.add_argument("--requests", type=int, default=100, help="Số request mỗi mức đồng thời")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--trainings", type=int, default=200)
+    parser.add_argument("--meals", type=int, default=100)
+    parser.add_argument("--gemini-latency", type=float, default=0.5, help="Độ trễ Gemini giả (giây)")
+    parser.add_argument("--gemini-chars", type=int, default=800)
+    parser.add_argument("--here-latency", type=float, default=0.05, help="Độ trễ HERE giả (giây)")
+    parser.add_argument("--here-failure-rate", type=float, default=0.0)
+    parser.add_argument("--mongo-uri", help="mongod local (các collection benchmark sẽ bị xóa); mặc định mongomock")
+    parser.add_argument("--disable-caches", action="store_true", help="Tắt cache lộ trình / chat / sân")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="File JSON kết quả, mặc định benchmarks/results/<thời gian>.json")
+    parser.add_argument("--compare", help="File JSON của lần chạy trước để so sánh")
+    args = parser.parse_args(argv)
+
+    scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Kịch bản không hợp lệ: {', '.join(sorted(unknown))}")
+    levels = [int(c) for c in args.concurrency.split(",")]
+
+    here = FakeHereServer(latency=args.here_latency, failure_rate=args.here_failure_rate, seed=args.seed).start()
+    app_module = load_app(args.mongo_uri)
+    user_ids = [str(uid) for uid in install_stubs(
+        app_module,
+        users=args.users,
+        trainings=args.trainings,
+        meals=args.meals,
+        gemini_latency=args.gemini_latency,
+        gemini_chars=args.gemini_chars,
+        here_url=here.url,
+        caches=not args.disable_caches,
+    )]
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    results = []
+    try:
+        for name in scenarios:
+            for concurrency in levels:
+                fn = make_scenario(name, base_url, user_ids, args.seed)
+                runs, elapsed = drive(fn, args.requests, concurrency)
+                row = dict({"scenario": name, "concurrency": concurrency}, **summarize(runs, elapsed))
+                results.append(row)
+                print(json.dumps(row, ensure_ascii=False))
+    finally:
+        server.shutdown()
+        here.stop()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "mongo": args.mongo_uri or "mongomock",
+            "params": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+            "hereCalls": here.calls,
+        },
+        "results": results,
+    }
+
+    output = args.output or os.path.join(
+        ROOT, "benchmarks", "results", datetime.now().strftime("%Y%m%d-%H%M%S") + ".json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Đã lưu kết quả: {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
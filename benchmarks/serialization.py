@@ -0,0 +1,142 @@
+"""
+So sánh serialize response lộ trình: JSON mặc định của Flask (json chuẩn, sort_keys,
+escape tiếng Việt, ObjectId phải đổi sang str trước) với FastJSONProvider (orjson),
+kèm số byte sau khi nén gzip / brotli.
+
+    python -m benchmarks.serialization --repeat 2000
+"""
+import argparse
+import gzip
+import json
+import random
+import time
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from flask.json.provider import DefaultJSONProvider
+
+from benchmarks.stubs import LEVELS, load_app
+
+NOTES = [
+    "Khởi động kỹ cổ tay, vai trước khi tập, giữ nhịp thở đều",
+    "Tập trung vào bước chân, di chuyển về giữa sân sau mỗi cú đánh",
+    "Giữ khuỷu tay cao khi đập cầu, dùng lực cổ tay ở cuối động tác",
+    "Nghỉ 30 giây giữa các hiệp, uống nước đầy đủ",
+]
+
+
+def make_plans(rng, days=7, workouts=6):
+    """3 lộ trình dạng output AI (như response sinh lộ trình)"""
+    return [
+        {
+            "name": f"Lộ trình {level} 1 tuần",
+            "description": f"Lộ trình tập luyện cấp độ {level} giúp tăng sức bền và phản xạ",
+            "goal": "Tăng sức bền, Cải thiện phản xạ",
+            "level": level,
+            "days": [
+                {
+                    "day": day,
+                    "workouts": [
+                        {
+                            "trainingName": f"Bài tập {level} số {rng.randint(1, 200)}",
+                            "note": rng.choice(NOTES),
+                            "time": f"{rng.randint(6, 20):02d}:00",
+                            "order": order,
+                        }
+                        for order in range(1, workouts + 1)
+                    ],
+                }
+                for day in range(1, days + 1)
+            ],
+        }
+        for level in LEVELS
+    ]
+
+
+def make_stored(app_module, plans):
+    """Document trainingplans tương ứng (ObjectId, datetime lồng nhau)"""
+    training_map = {
+        w["trainingName"]: str(ObjectId())
+        for p in plans for d in p["days"] for w in d["workouts"]
+    }
+    meta = {
+        "userId": ObjectId(),
+        "sourceGoal": "Tăng sức bền, Cải thiện phản xạ",
+        "profileKey": "0" * 40,
+        "generationId": str(ObjectId()),
+        "generation": {"engine": "gemini", "mode": "single", "model": "gemini", "catalogVersion": 1},
+        "createdAt": datetime.now(timezone.utc),
+    }
+    docs = [app_module.build_plan_doc(p, training_map, meta) for p in plans]
+    for d in docs:
+        d["_id"] = ObjectId()
+    return {"planIds": [str(d["_id"]) for d in docs], "plans": docs, "cached": True, "engine": "stored"}
+
+
+def to_plain(value):
+    """Cách cũ: đổi ObjectId / datetime sang str trước khi jsonify"""
+    if isinstance(value, dict):
+        return {k: to_plain(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [to_plain(v) for v in value]
+    if isinstance(value, (ObjectId, datetime)):
+        return str(value)
+    return value
+
+
+def timed(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        body = fn()
+    return (time.perf_counter() - start) / repeat, body
+
+
+def measure(name, payload, app_module, repeat):
+    default = DefaultJSONProvider(app_module.app)
+    encoders = {
+        "flask-default": lambda: default.dumps(to_plain(payload), separators=(",", ":")).encode("utf-8"),
+        "fast": lambda: app_module.dumps_bytes(payload),
+    }
+
+    rows = []
+    for encoder, fn in encoders.items():
+        seconds, body = timed(fn, repeat)
+        row = {
+            "payload": name,
+            "encoder": encoder,
+            "orjson": app_module.orjson is not None,
+            "encodeUs": round(seconds * 1e6, 1),
+            "bytes": len(body),
+            "gzipBytes": len(gzip.compress(body, compresslevel=app_module.COMPRESS_LEVEL)),
+        }
+        gzip_seconds, _ = timed(lambda: gzip.compress(body, compresslevel=app_module.COMPRESS_LEVEL), max(1, repeat // 10))
+        row["gzipUs"] = round(gzip_seconds * 1e6, 1)
+        if app_module.brotli is not None:
+            row["brotliBytes"] = len(app_module.brotli.compress(body, quality=app_module.COMPRESS_LEVEL))
+        rows.append(row)
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.serialization")
+    parser.add_argument("--repeat", type=int, default=1000)
+    parser.add_argument("--workouts", type=int, default=6, help="Số bài tập mỗi ngày")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+
+    app_module = load_app()
+    rng = random.Random(args.seed)
+    plans = make_plans(rng, workouts=args.workouts)
+    payloads = {
+        "generated": {"message": "Đã tạo và lưu 3 lộ trình thành công", "plans": plans, "cached": False, "engine": "gemini"},
+        "stored": make_stored(app_module, plans),
+    }
+
+    for name, payload in payloads.items():
+        for row in measure(name, payload, app_module, args.repeat):
+            print(json.dumps(row, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+So sánh throughput của worker sync và gevent khi Gemini chậm (POST /chat).
+
+    python -m benchmarks.serving --concurrency 100 --requests 300 --latency 1.0
+
+Mỗi chế độ khởi động 1 tiến trình gunicorn với benchmarks.stub_app:app.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import requests
+
+from benchmarks.common import drive, free_port, summarize
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def wait_ready(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.post(url, json={}, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server không khởi động được: {url}")
+
+
+def run(worker_class, args):
+    port = free_port()
+    env = dict(
+        os.environ,
+        GUNICORN_WORKER_CLASS=worker_class,
+        WEB_CONCURRENCY=str(args.workers),
+        BENCH_GEMINI_LATENCY=str(args.latency),
+        BENCH_CACHES="0",
+    )
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+         "--bind", f"127.0.0.1:{port}", "benchmarks.stub_app:app"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}/chat"
+    try:
+        wait_ready(url)
+
+        def one(i):
+            return requests.post(url, json={"message": f"Làm sao để đập cầu mạnh hơn? #{i}"}, timeout=300).status_code
+
+        results, elapsed = drive(one, args.requests, args.concurrency)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+    return dict(
+        {"workerClass": worker_class, "workers": args.workers, "concurrency": args.concurrency},
+        **summarize(results, elapsed),
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.serving")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=1.0, help="Độ trễ Gemini giả (giây)")
+    parser.add_argument("--modes", default="sync,gevent")
+    args = parser.parse_args(argv)
+
+    for mode in args.modes.split(","):
+        print(json.dumps(run(mode, args), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
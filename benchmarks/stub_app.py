@@ -0,0 +1,31 @@
+"""
+App Flask chạy với Mongo giả (mongomock) và Gemini giả, dùng cho benchmark:
+
+    gunicorn -c gunicorn.conf.py benchmarks.stub_app:app
+
+Biến môi trường:
+    BENCH_MONGO_URI       dùng mongod local thay cho mongomock
+    BENCH_GEMINI_LATENCY  độ trễ Gemini giả (giây), mặc định 1.0
+    BENCH_GEMINI_CHARS    độ dài câu trả lời chat, mặc định 800
+    BENCH_HERE_URL        URL HERE Discover giả
+    BENCH_CACHES          0 để tắt cache lộ trình / chat / sân
+    BENCH_USERS, BENCH_TRAININGS, BENCH_MEALS  số document seed
+"""
+import os
+
+from benchmarks.stubs import install_stubs, load_app
+
+app_module = load_app(os.getenv("BENCH_MONGO_URI"))
+
+user_ids = install_stubs(
+    app_module,
+    users=int(os.getenv("BENCH_USERS", "100")),
+    trainings=int(os.getenv("BENCH_TRAININGS", "200")),
+    meals=int(os.getenv("BENCH_MEALS", "100")),
+    gemini_latency=float(os.getenv("BENCH_GEMINI_LATENCY", "1.0")),
+    gemini_chars=int(os.getenv("BENCH_GEMINI_CHARS", "800")),
+    here_url=os.getenv("BENCH_HERE_URL"),
+    caches=os.getenv("BENCH_CACHES", "1") != "0",
+)
+
+app = app_module.app
@@ -0,0 +1,240 @@
+"""
+Thành phần giả lập cho benchmark: Gemini giả (độ trễ + độ dài output cấu hình được),
+HERE Discover giả (HTTP server local), dữ liệu seed cho users / trainings / meals
+và hàm nạp app với Mongo giả (mongomock) hoặc mongod local.
+"""
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+LEVELS = ["Cơ bản", "Trung bình", "Nâng cao"]
+GOALS = ["Tăng sức bền", "Cải thiện đập cầu", "Cải thiện di chuyển", "Giảm cân", "Tăng phản xạ"]
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGeminiModel:
+    """
+    Thay cho genai.GenerativeModel: ngủ `latency` giây (giống chờ mạng) rồi trả về
+    text dài ~`chars` ký tự. Prompt lộ trình nhận JSON plans hợp lệ từ catalog seed.
+    """
+
+    def __init__(self, training_names, latency=1.0, chars=800, chunks=20):
+        self.training_names = training_names
+        self.latency = latency
+        self.chars = chars
+        self.chunks = chunks
+
+    def _text(self, prompt):
+        if '"plans"' in prompt or '"days"' in prompt:
+            return json.dumps(self._plans(prompt), ensure_ascii=False)
+        sentence = "Bạn nên khởi động kỹ, tập đều đặn và ăn đủ chất trước khi ra sân. "
+        return "Chào bạn! " + (sentence * (self.chars // len(sentence) + 1))[: self.chars]
+
+    def _plans(self, prompt):
+        plans = []
+        for level in LEVELS:
+            if '"plans"' not in prompt and f'"level": "{level}"' not in prompt:
+                continue
+            names = self.training_names.get(level) or [n for ns in self.training_names.values() for n in ns]
+            days = [
+                {
+                    "day": day,
+                    "workouts": [
+                        {"trainingName": names[(day + i) % len(names)], "note": "Tập đúng kỹ thuật", "time": "18:00", "order": i + 1}
+                        for i in range(min(4, len(names)))
+                    ],
+                }
+                for day in range(1, 8)
+            ]
+            plans.append({"name": f"Lộ trình {level}", "description": "", "goal": "", "level": level, "days": days})
+        return {"plans": plans} if '"plans"' in prompt else plans[0]
+
+    def generate_content(self, prompt, generation_config=None, stream=False, **kwargs):
+        text = self._text(prompt)
+        if not stream:
+            time.sleep(self.latency)
+            return FakeResponse(text)
+        return self._stream(text)
+
+    def _stream(self, text):
+        size = max(1, len(text) // self.chunks)
+        delay = self.latency / self.chunks
+        for i in range(0, len(text), size):
+            time.sleep(delay)
+            yield FakeResponse(text[i:i + size])
+
+
+def seed_database(db, users=100, trainings=200, meals=100, seed=42):
+    """
+    Seed dữ liệu tổng hợp, trả về (danh sách user id, dict cấp độ → tên bài tập)
+    """
+    rng = random.Random(seed)
+
+    training_docs = []
+    training_names = {level: [] for level in LEVELS}
+    for i in range(trainings):
+        level = LEVELS[i % len(LEVELS)]
+        title = f"Bài tập {i + 1}"
+        training_names[level].append(title)
+        training_docs.append({
+            "title": title,
+            "goal": rng.sample(GOALS, 2) if i % 2 else rng.choice(GOALS),
+            "level": level,
+            "description": f"Bài tập {level.lower()} giúp {rng.choice(GOALS).lower()}, thực hiện {rng.randint(3, 5)} hiệp.",
+        })
+
+    meal_docs = [
+        {
+            "name": f"Món ăn {i + 1}",
+            "calories": rng.randint(150, 800),
+            "goal": rng.choice(GOALS),
+            "mealType": rng.choice(["Sáng", "Trưa", "Tối", "Ăn nhẹ"]),
+            "description": "Giàu protein và tinh bột, phù hợp trước buổi tập.",
+        }
+        for i in range(meals)
+    ]
+
+    user_docs = [
+        {
+            "name": f"User {i + 1}",
+            "goal": rng.sample(GOALS, rng.randint(1, 2)),
+            "badmintonLevel": rng.choice(LEVELS),
+            "badmintonExperience": f"{rng.randint(0, 10)} năm",
+            "height": rng.randint(150, 190),
+            "weight": rng.randint(45, 90),
+            "passwordHash": "x",
+        }
+        for i in range(users)
+    ]
+
+    if training_docs:
+        db["trainings"].insert_many(training_docs)
+    if meal_docs:
+        db["meals"].insert_many(meal_docs)
+    user_ids = [str(i) for i in db["users"].insert_many(user_docs).inserted_ids] if user_docs else []
+    return user_ids, training_names
+
+
+class FakeHereServer:
+    """
+    HTTP server local giả lập HERE Discover (/v1/discover): trả về `items` sân
+    quanh tọa độ `at`, có độ trễ và tỉ lệ lỗi cấu hình được (mặc định 503,
+    `failure_status=429` + `retry_after` để giả lập bị giới hạn tần suất).
+    """
+
+    def __init__(self, latency=0.05, failure_rate=0.0, items=8, seed=42, failure_status=503, retry_after=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.retry_after = retry_after
+        self.items = items
+        self.calls = 0
+        self._rng = random.Random(seed)
+        self._server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}/v1/discover"
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.calls += 1
+                time.sleep(fake.latency)
+                if fake._rng.random() < fake.failure_rate:
+                    self.send_response(fake.failure_status)
+                    if fake.retry_after is not None:
+                        self.send_header("Retry-After", str(fake.retry_after))
+                    self.end_headers()
+                    return
+
+                query = parse_qs(urlparse(self.path).query)
+                lat, lng = (float(v) for v in query["at"][0].split(","))
+                body = json.dumps({"items": fake.places(lat, lng, query.get("q", [""])[0])}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def places(self, lat, lng, q):
+        # Sân cố định theo lưới ~0.01 độ để các tọa độ gần nhau trả về cùng sân
+        base_lat, base_lng = round(lat, 2), round(lng, 2)
+        return [
+            {
+                "id": f"here:fake:{base_lat}:{base_lng}:{i}",
+                "title": f"Sân cầu lông {q} {i + 1}",
+                "position": {"lat": base_lat + 0.004 * (i % 3), "lng": base_lng + 0.004 * (i // 3)},
+                "address": {"label": f"{i + 1} Đường số {i + 1}"},
+                "contacts": [{"phone": [{"value": f"090000{i:04d}"}]}],
+                "openingHours": [{"isOpen": i % 2 == 0}],
+            }
+            for i in range(self.items)
+        ]
+
+
+def load_app(mongo_uri=None):
+    """
+    Import module app. Không có mongo_uri → dùng mongomock (không cần Mongo thật).
+    Với mongo_uri (vd mongod local), các collection benchmark sẽ bị xóa khi seed.
+    """
+    os.environ.setdefault("MODEL_NAME", "gemini-bench")
+    os.environ.setdefault("HERE_API_KEY", "bench")
+    if mongo_uri:
+        os.environ["MONGO_URI"] = mongo_uri
+    else:
+        import mongomock
+        import pymongo
+
+        os.environ["MONGO_URI"] = "mongodb://localhost:27017"
+        pymongo.MongoClient = mongomock.MongoClient
+
+    import app as app_module
+    return app_module
+
+
+def install_stubs(app_module, users=100, trainings=200, meals=100,
+                  gemini_latency=1.0, gemini_chars=800, here_url=None, caches=True):
+    """Seed dữ liệu, thay Gemini bằng FakeGeminiModel, trỏ HERE về server giả"""
+    for name in ("users", "trainings", "meals", "trainingplans", "jobs", "courts", "courttiles", "plancache"):
+        app_module.db[name].delete_many({})
+
+    user_ids, training_names = seed_database(app_module.db, users=users, trainings=trainings, meals=meals)
+    app_module.catalog.invalidate()
+    app_module.model = FakeGeminiModel(training_names, latency=gemini_latency, chars=gemini_chars)
+    if here_url:
+        app_module.HERE_DISCOVER_URL = here_url
+    if not caches:
+        disable_caches(app_module)
+    return user_ids
+
+
+def disable_caches(app_module):
+    """Tắt cache lộ trình, chat và sân để đo đúng chi phí gọi Gemini / HERE"""
+    app_module.plan_cache.max_size = 0
+    app_module.plan_cache.collection = None
+    app_module.chat_cache.max_size = 0
+    app_module.court_cache.ttl = 0
@@ -0,0 +1,21 @@
+import os
+
+# Chế độ phục vụ:
+#   sync   - mặc định, mỗi worker xử lý 1 request tại 1 thời điểm
+#   gevent - mỗi worker giữ được hàng trăm request đang chờ Gemini / Mongo / HERE
+#            (I/O được monkey-patch, Gemini dùng transport REST)
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+
+# Import app 1 lần trong master rồi fork worker (client Mongo / Gemini / HTTP
+# được tạo lười trong từng worker nên vẫn an toàn khi fork)
+preload_app = os.getenv("GUNICORN_PRELOAD", "0") == "1"
+
+
+def post_worker_init(worker):
+    # APP_WARMUP=1: làm nóng worker (Mongo, catalog, Gemini) trước khi nhận request
+    if os.getenv("APP_WARMUP", "0") == "1":
+        import app
+        app.warmup()
@@ -0,0 +1,32 @@
+import pytest
+
+from benchmarks.stubs import FakeHereServer, install_stubs, load_app
+
+
+@pytest.fixture(scope="session")
+def app_module():
+    """Module app với Mongo giả (mongomock)"""
+    return load_app()
+
+
+@pytest.fixture
+def user_ids(app_module, monkeypatch):
+    """Seed lại dữ liệu, Gemini giả không trễ, cache chat rỗng cho mỗi test"""
+    ids = install_stubs(app_module, users=5, trainings=30, meals=10, gemini_latency=0, gemini_chars=300)
+    monkeypatch.setattr(app_module, "chat_cache", app_module.ChatAnswerCache())
+    return [str(uid) for uid in ids]
+
+
+@pytest.fixture
+def client(app_module, user_ids):
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def here(app_module, user_ids, monkeypatch):
+    """HERE giả không trễ, breaker HERE mới cho mỗi test"""
+    server = FakeHereServer(latency=0).start()
+    monkeypatch.setattr(app_module, "HERE_DISCOVER_URL", server.url)
+    monkeypatch.setattr(app_module, "here_breaker", app_module.CircuitBreaker("here", failure_threshold=5, reset_timeout=30))
+    yield server
+    server.stop()
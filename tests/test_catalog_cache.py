@@ -0,0 +1,58 @@
+import pytest
+
+
+@pytest.fixture
+def cache(app_module, user_ids):
+    """CatalogCache mới trên Mongo giả đã seed, đếm số lần load"""
+    cache = app_module.CatalogCache(app_module.db, ttl=60)
+    load = cache._load
+    cache.loads = 0
+
+    def counting_load():
+        cache.loads += 1
+        return load()
+
+    cache._load = counting_load
+    return cache
+
+
+def test_served_from_memory_within_ttl(cache):
+    first = cache.get()
+    assert cache.get() is first
+    assert cache.loads == 1
+
+
+def test_version_is_content_checksum(app_module, cache):
+    other = app_module.CatalogCache(app_module.db)
+    assert cache.version == other.version
+    assert cache.training_version == other.training_version
+
+    app_module.db["meals"].insert_one({"name": "Cháo yến mạch", "calories": 250})
+    cache.invalidate()
+
+    assert cache.version != other.version
+    # Chỉ meals đổi → training_version giữ nguyên
+    assert cache.training_version == other.training_version
+
+
+def test_expired_snapshot_is_served_while_another_request_refreshes(cache):
+    old = cache.get()
+    cache.invalidate()
+
+    with cache._refresh_lock:
+        assert cache.get() is old
+    assert cache.loads == 1
+
+    assert cache.get() is not old
+    assert cache.loads == 2
+
+
+def test_refresh_error_keeps_old_snapshot(cache, monkeypatch):
+    old = cache.get()
+    cache.invalidate()
+
+    def broken_load():
+        raise RuntimeError("mongo down")
+
+    monkeypatch.setattr(cache, "_load", broken_load)
+    assert cache.get() is old
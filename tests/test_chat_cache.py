@@ -0,0 +1,88 @@
+from benchmarks.stubs import FakeResponse
+
+PROFILE_A = {
+    "name": "Trần Bảo Mật",
+    "badmintonExperience": "17 năm thi đấu",
+    "height": 191,
+    "weight": 87,
+}
+
+
+class EchoModel:
+    """Gemini giả trả lại nguyên prompt: thông tin nào lọt vào prompt sẽ lọt vào câu trả lời"""
+
+    def __init__(self):
+        self.prompts = []
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        self.prompts.append(prompt)
+        if stream:
+            return iter([FakeResponse(prompt[i:i + 200]) for i in range(0, len(prompt), 200)])
+        return FakeResponse(prompt)
+
+
+def same_bucket_users(app_module):
+    """2 user cùng trình độ + mục tiêu (cùng chat_bucket), hồ sơ cá nhân khác nhau"""
+    base = {"badmintonLevel": "Trung bình", "goal": ["Tăng sức bền"]}
+    user_a = app_module.users.insert_one(dict(base, **PROFILE_A)).inserted_id
+    user_b = app_module.users.insert_one(dict(base, name="Lê Văn B", height=160, weight=55)).inserted_id
+    return str(user_a), str(user_b)
+
+
+def assert_no_profile_a(text):
+    for value in PROFILE_A.values():
+        assert str(value) not in text
+
+
+def test_cached_answer_has_no_profile_of_first_asker(app_module, client, monkeypatch):
+    model = EchoModel()
+    monkeypatch.setattr(app_module, "model", model)
+    user_a, user_b = same_bucket_users(app_module)
+
+    client.post("/chat", json={"message": "Nên tập gì để tăng sức bền?", "userId": user_a})
+    reply = client.post("/chat", json={"message": "Nên tập gì để tăng sức bền?", "userId": user_b}).get_json()["reply"]
+
+    assert len(model.prompts) == 1
+    assert_no_profile_a(reply)
+
+
+def test_stream_cached_answer_has_no_profile_of_first_asker(app_module, client, monkeypatch):
+    model = EchoModel()
+    monkeypatch.setattr(app_module, "model", model)
+    user_a, user_b = same_bucket_users(app_module)
+
+    client.post("/chat/stream", json={"message": "Ăn gì trước khi tập?", "userId": user_a}).get_data()
+    body = client.post("/chat/stream", json={"message": "Ăn gì trước khi tập?", "userId": user_b}).get_data(as_text=True)
+
+    assert len(model.prompts) == 1
+    assert_no_profile_a(body)
+
+
+def test_session_answer_is_not_shared(app_module, client, monkeypatch):
+    model = EchoModel()
+    monkeypatch.setattr(app_module, "model", model)
+    user_a, user_b = same_bucket_users(app_module)
+
+    # Prompt của phiên có đủ hồ sơ user A → câu trả lời không được vào cache dùng chung
+    first = client.post("/chat", json={"message": "Tập bao lâu?", "userId": user_a, "sessionId": "new"}).get_json()
+    reply = client.post("/chat", json={"message": "Tập bao lâu?", "userId": user_b}).get_json()["reply"]
+
+    assert PROFILE_A["name"] in model.prompts[0]
+    assert "sessionId" in first
+    assert len(model.prompts) == 2
+    assert_no_profile_a(reply)
+
+
+def test_content_words_are_not_stop_words(app_module):
+    # "cơ bản" / "thể lực" bỏ dấu trùng "có bạn" / "thế" nhưng là từ có nghĩa
+    assert app_module.normalize_question("Gợi ý bài tập cơ bản") != app_module.normalize_question("Gợi ý bài tập")
+    assert "the luc" in app_module.normalize_question("Tăng thể lực thế nào?")
+    assert "co ban" in app_module.normalize_question("goi y bai tap co ban")
+
+
+def test_fillers_are_ignored_when_matching(app_module):
+    cache = app_module.ChatAnswerCache()
+    cache.set("Gợi ý bài tập", "bucket", "Nhảy dây")
+
+    assert cache.get("Bạn ơi, gợi ý bài tập giúp mình với", "bucket") == "Nhảy dây"
+    assert cache.get("Gợi ý bài tập cơ bản", "bucket") is None
@@ -0,0 +1,16 @@
+def test_chat_prefix_keeps_every_retrieved_item(app_module):
+    trainings = [{"name": f"Bài tập {i}", "level": "Cơ bản", "goal": "Tăng sức bền"} for i in range(40)]
+    meals = [{"name": f"Món {i}", "calories": 300} for i in range(30)]
+
+    prefix = app_module.build_chat_prefix(trainings, meals)
+
+    assert all(f"- Bài tập {i} (" in prefix for i in range(40))
+    assert all(f"- Món {i} (" in prefix for i in range(30))
+
+
+def test_catalog_fallback_is_capped_by_top_k(app_module, user_ids, monkeypatch):
+    monkeypatch.setattr(app_module, "CHAT_TRAINING_TOP_K", 7)
+    monkeypatch.setattr(app_module, "CHAT_MEAL_TOP_K", 4)
+
+    assert len(app_module.get_training_list()) == 7
+    assert len(app_module.get_meal_list()) == 4
@@ -0,0 +1,111 @@
+import json
+
+import pytest
+
+from benchmarks.stubs import FakeResponse
+
+MARKDOWN_TEXTS = [
+    "**Đập cầu** cần *cổ tay* linh hoạt",
+    "Ví dụ:\n```\ntập 3 hiệp\n```\nxong",
+    "``a`b```c````d*****e`",
+    "Kết thúc bằng dấu `",
+    "``````",
+]
+
+
+def reference_strip(text):
+    return text.replace("**", "").replace("*", "").replace("```", "")
+
+
+def strip_chunks(app_module, chunks):
+    stripper = app_module.MarkdownStripper()
+    return "".join(stripper.feed(c) for c in chunks) + stripper.flush()
+
+
+@pytest.mark.parametrize("text", MARKDOWN_TEXTS)
+def test_markdown_stripper_every_split_point(app_module, text):
+    for i in range(len(text) + 1):
+        for j in range(i, len(text) + 1):
+            chunks = [text[:i], text[i:j], text[j:]]
+            assert strip_chunks(app_module, chunks) == reference_strip(text), chunks
+
+
+@pytest.mark.parametrize("text", MARKDOWN_TEXTS)
+def test_markdown_stripper_single_chars(app_module, text):
+    assert strip_chunks(app_module, list(text)) == reference_strip(text)
+
+
+def parse_sse(body):
+    """Danh sách (event, data) theo đúng thứ tự server gửi"""
+    events = []
+    for block in body.strip().split("\n\n"):
+        event = None
+        data = None
+        for line in block.splitlines():
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                data = json.loads(line[len("data: "):])
+        events.append((event, data))
+    return events
+
+
+class ChunkedModel:
+    """Gemini giả trả đúng các chunk cho trước"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.calls = 0
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        self.calls += 1
+        if not stream:
+            return FakeResponse("".join(self.chunks))
+        return iter([FakeResponse(c) for c in self.chunks])
+
+
+def stream_chat(client, **body):
+    response = client.post("/chat/stream", json=body)
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    return parse_sse(response.get_data(as_text=True))
+
+
+def test_sse_event_order(app_module, client, user_ids, monkeypatch):
+    model = ChunkedModel(["  **Nên** khởi", "động kỹ `", "``cổ tay``", "` trước khi tập."])
+    monkeypatch.setattr(app_module, "model", model)
+    user_name = app_module.users.find_one()["name"]
+
+    events = stream_chat(client, message="Làm sao tránh chấn thương cổ tay?", userId=user_ids[0])
+
+    *deltas, done = events
+    assert deltas[0] == (None, {"delta": f"Chào {user_name}! "})
+    assert all(event is None and set(data) == {"delta"} for event, data in deltas)
+    assert done[0] == "done"
+    reply = "".join(data["delta"] for _, data in deltas)
+    assert done[1]["reply"] == reply
+    assert reply == f"Chào {user_name}! " + reference_strip("".join(model.chunks)).strip()
+
+
+def test_sse_cached_reply(app_module, client, monkeypatch):
+    model = ChunkedModel(["Nên ăn ", "chuối trước khi tập."])
+    monkeypatch.setattr(app_module, "model", model)
+
+    first = stream_chat(client, message="Nên ăn gì trước khi tập?")
+    second = stream_chat(client, message="Nên ăn gì trước khi tập?")
+
+    assert model.calls == 1
+    assert [event for event, _ in second] == [None, None, "done"]
+    assert second[-1] == first[-1]
+
+
+def test_sse_session_id_in_done_event(app_module, client, user_ids, monkeypatch):
+    monkeypatch.setattr(app_module, "model", ChunkedModel(["Tập 3 buổi ", "mỗi tuần."]))
+
+    first = stream_chat(client, message="Tập bao nhiêu buổi?", userId=user_ids[0], sessionId="new")
+    session_id = first[-1][1]["sessionId"]
+    second = stream_chat(client, message="Còn nghỉ ngơi?", userId=user_ids[0], sessionId=session_id)
+
+    assert second[-1][1]["sessionId"] == session_id
+    # Lượt sau của phiên không chào lại
+    assert not second[0][1]["delta"].startswith("Chào")
@@ -0,0 +1,47 @@
+from datetime import datetime, timezone
+
+import pytest
+
+
+@pytest.fixture
+def nearby(app_module, client, here, monkeypatch):
+    """POST /api/nearby-courts với cache tile rỗng"""
+    monkeypatch.setenv("HERE_API_KEY", "test-key")
+    app_module.courttiles.delete_many({})
+    app_module.courts.delete_many({})
+
+    def post(latitude, longitude):
+        response = client.post("/api/nearby-courts", json={"latitude": latitude, "longitude": longitude})
+        assert response.status_code == 200
+        return response.get_json()["courts"]
+
+    return post
+
+
+def test_same_tile_is_served_from_cache(nearby, here):
+    first = nearby(10.8231, 106.6297)
+    calls = here.calls
+    assert calls > 0 and first
+
+    second = nearby(10.8300, 106.6350)
+    assert here.calls == calls
+    assert second
+    distances = [c["distance"] for c in second]
+    assert distances == sorted(distances)
+
+
+def test_other_tile_calls_here(nearby, here):
+    nearby(10.8231, 106.6297)
+    calls = here.calls
+
+    nearby(10.9500, 106.8000)
+    assert here.calls > calls
+
+
+def test_expired_tile_calls_here_again(app_module, nearby, here):
+    nearby(10.8231, 106.6297)
+    calls = here.calls
+
+    app_module.courttiles.update_many({}, {"$set": {"expiresAt": datetime(2000, 1, 1, tzinfo=timezone.utc)}})
+    nearby(10.8231, 106.6297)
+    assert here.calls > calls
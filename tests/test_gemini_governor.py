@@ -0,0 +1,72 @@
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def exhausted_governor(app_module, monkeypatch):
+    """Ngân sách 1 request/phút đã dùng hết, lane chat chỉ chờ tối đa 0.1s"""
+    lanes = dict(app_module.GEMINI_LANES, chat=(5, 0.1))
+    governor = app_module.GeminiGovernor(rpm=1, tpm=0, lanes=lanes)
+    governor.exhaust()
+    monkeypatch.setattr(app_module, "gemini_governor", governor)
+    return governor
+
+
+@pytest.mark.parametrize("path", ["/chat", "/chat/stream"])
+def test_chat_returns_429_when_budget_is_exhausted(app_module, client, user_ids, exhausted_governor, path):
+    response = client.post(path, json={"message": "Nên tập gì?", "userId": user_ids[0]})
+
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+
+
+def make_governor(app_module, rpm, **lanes):
+    return app_module.GeminiGovernor(rpm=rpm, tpm=0, lanes=dict(app_module.GEMINI_LANES, **lanes))
+
+
+def test_full_lane_is_shed_immediately(app_module):
+    governor = make_governor(app_module, rpm=60, chat=(0, 10))
+
+    with pytest.raises(app_module.GeminiRateLimited) as info:
+        governor.acquire("chat", 100)
+    assert info.value.lane == "chat"
+    assert info.value.retry_after >= 1
+
+
+def test_wait_longer_than_max_wait_is_shed_with_retry_after(app_module):
+    governor = make_governor(app_module, rpm=1, plan=(5, 0.1))
+    governor.acquire("plan", 100)
+
+    start = time.monotonic()
+    with pytest.raises(app_module.GeminiRateLimited) as info:
+        governor.acquire("plan", 100)
+    assert time.monotonic() - start < 0.1
+    assert info.value.retry_after > 1
+
+
+def test_chat_lane_goes_before_waiting_batch(app_module):
+    governor = make_governor(app_module, rpm=300)
+    governor.exhaust()
+    order = []
+
+    def call(lane):
+        governor.acquire(lane, 100)
+        order.append(lane)
+
+    batch = threading.Thread(target=call, args=("batch",))
+    batch.start()
+    time.sleep(0.05)
+    chat = threading.Thread(target=call, args=("chat",))
+    chat.start()
+    batch.join(5)
+    chat.join(5)
+
+    assert order == ["chat", "batch"]
+
+
+def test_unlimited_governor_never_waits(app_module):
+    governor = make_governor(app_module, rpm=0, chat=(0, 0))
+    for _ in range(100):
+        governor.acquire("chat", 10 ** 6)
@@ -0,0 +1,90 @@
+import time
+
+import requests
+
+
+def test_rate_limit_is_not_retried_or_slept(app_module, here):
+    here.failure_rate = 1.0
+    here.failure_status = 429
+    here.retry_after = 3
+
+    start = time.perf_counter()
+    try:
+        app_module.here_get({"at": "10.8,106.6", "q": "badminton", "apiKey": "secret"})
+    except requests.HTTPError as e:
+        assert e.response.status_code == 429
+    else:
+        raise AssertionError("429 phải raise")
+
+    assert time.perf_counter() - start < 1
+    assert here.calls == 1
+    assert app_module.here_breaker._failures == 1
+
+
+def test_server_errors_are_retried(app_module, here):
+    here.failure_rate = 1.0
+
+    try:
+        app_module.here_get({"at": "10.8,106.6", "q": "badminton", "apiKey": "secret"})
+    except requests.HTTPError as e:
+        assert e.response.status_code == 503
+    else:
+        raise AssertionError("503 phải raise")
+
+    assert here.calls == 1 + app_module.HTTP_RETRIES
+
+
+def nearby_with_failing_here(app_module, client, monkeypatch, capsys):
+    monkeypatch.setenv("HERE_API_KEY", "here-secret-key")
+    app_module.courttiles.delete_many({})
+    response = client.post("/api/nearby-courts", json={"latitude": 10.8231, "longitude": 106.6297})
+    return response.get_data(as_text=True) + capsys.readouterr().out
+
+
+def assert_no_api_key(text):
+    assert "here-secret-key" not in text
+    assert "apiKey" not in text
+
+
+def test_http_error_does_not_leak_api_key(app_module, client, here, monkeypatch, capsys):
+    for status in (429, 503):
+        here.failure_rate = 1.0
+        here.failure_status = status
+        assert_no_api_key(nearby_with_failing_here(app_module, client, monkeypatch, capsys))
+
+
+def test_connection_error_does_not_leak_api_key(app_module, client, here, monkeypatch, capsys):
+    here.stop()
+    output = nearby_with_failing_here(app_module, client, monkeypatch, capsys)
+    assert "HERE API Error" in output
+    assert_no_api_key(output)
+
+
+def test_breaker_opens_after_threshold_and_short_circuits(app_module, here):
+    here.failure_rate = 1.0
+    here.failure_status = 429
+    params = {"at": "10.8,106.6", "q": "badminton", "apiKey": "secret"}
+    threshold = app_module.here_breaker.failure_threshold
+
+    for _ in range(threshold):
+        try:
+            app_module.here_get(params)
+        except requests.HTTPError:
+            pass
+    assert here.calls == threshold
+
+    try:
+        app_module.here_get(params)
+    except app_module.ServiceUnavailable:
+        pass
+    else:
+        raise AssertionError("breaker mở phải chặn request")
+    assert here.calls == threshold
+
+    # Hết reset_timeout → 1 request thử, thành công thì đóng mạch
+    here.failure_rate = 0.0
+    app_module.here_breaker.reset_timeout = 0.05
+    time.sleep(0.1)
+    assert "items" in app_module.here_get(params)
+    assert here.calls == threshold + 1
+    assert not app_module.here_breaker.is_open
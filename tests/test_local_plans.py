@@ -0,0 +1,53 @@
+import re
+
+LEVELS = ["Cơ bản", "Trung bình", "Nâng cao"]
+
+
+def catalog_trainings(levels=LEVELS, per_level=8):
+    return [
+        {"_id": f"{level}-{i}", "title": f"{level} bài {i}", "level": level, "description": f"Mô tả {i}"}
+        for level in levels for i in range(per_level)
+    ]
+
+
+def test_local_plans_follow_prompt_rules(app_module):
+    trainings = catalog_trainings()
+    levels = {t["title"]: t["level"] for t in trainings}
+
+    plans = app_module.generate_local_plans("Tăng sức bền", trainings)["plans"]
+
+    assert [p["level"] for p in plans] == LEVELS
+    for plan in plans:
+        assert plan["goal"] == "Tăng sức bền"
+        assert [d["day"] for d in plan["days"]] == list(range(1, 8))
+        for day in plan["days"]:
+            workouts = day["workouts"]
+            assert 3 <= len(workouts) <= 6
+            assert [w["order"] for w in workouts] == list(range(1, len(workouts) + 1))
+            times = [w["time"] for w in workouts]
+            assert all(re.fullmatch(r"([01]\d|2[0-3]):[0-5]\d", t) for t in times)
+            assert times == sorted(times)
+            assert all(levels[w["trainingName"]] == plan["level"] for w in workouts)
+
+
+def test_local_plans_pass_validation_unchanged(app_module):
+    trainings = catalog_trainings()
+    training_map = {t["title"]: t["_id"] for t in trainings}
+    training_levels = {t["title"]: t["level"] for t in trainings}
+
+    plans = app_module.generate_local_plans("Giảm cân", trainings)["plans"]
+    valid, errors = app_module.validate_plans(plans, training_map, training_levels)
+
+    assert errors == []
+    assert valid == plans
+
+
+def test_level_without_trainings_uses_whole_catalog(app_module):
+    trainings = catalog_trainings(levels=["Cơ bản"])
+    titles = {t["title"] for t in trainings}
+
+    plans = app_module.generate_local_plans("Tăng sức bền", trainings)["plans"]
+
+    assert len(plans) == 3
+    assert all(w["trainingName"] in titles for p in plans for d in p["days"] for w in d["workouts"])
+    assert app_module.generate_local_plans("Tăng sức bền", trainings)["plans"] == plans
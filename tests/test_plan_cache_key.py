@@ -0,0 +1,7 @@
+def test_plan_key_matches_goal_buckets(app_module):
+    key = app_module.plan_cache_key("Tăng sức bền, Giảm cân", {"badmintonLevel": "Cơ bản"}, 1)
+
+    assert key == app_module.plan_cache_key("giam can; tang  suc ben;Tăng Sức Bền", {"badmintonLevel": "co ban"}, 1)
+    assert key != app_module.plan_cache_key("Tăng sức bền", {"badmintonLevel": "Cơ bản"}, 1)
+    assert key != app_module.plan_cache_key("Tăng sức bền, Giảm cân", {"badmintonLevel": "Nâng cao"}, 1)
+    assert key != app_module.plan_cache_key("Tăng sức bền, Giảm cân", {"badmintonLevel": "Cơ bản"}, 2)
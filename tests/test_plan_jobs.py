@@ -0,0 +1,20 @@
+import threading
+
+
+def test_same_goals_written_differently_share_one_job(app_module, user_ids, monkeypatch):
+    queue = app_module.PlanJobQueue(app_module.jobs)
+    release = threading.Event()
+    monkeypatch.setattr(queue, "_run", lambda *args: release.wait(5))
+    user_id = user_ids[0]
+
+    try:
+        app_module.users.update_one({"_id": app_module.ObjectId(user_id)}, {"$set": {"goal": ["Tăng sức bền", "Giảm cân"]}})
+        first, created = queue.submit(user_id)
+        assert created
+
+        app_module.users.update_one({"_id": app_module.ObjectId(user_id)}, {"$set": {"goal": "giam can,  TĂNG SỨC BỀN"}})
+        second, created = queue.submit(user_id)
+        assert not created
+        assert second["_id"] == first["_id"]
+    finally:
+        release.set()
@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+LEVELS = ["Cơ bản", "Trung bình", "Nâng cao"]
+
+
+def make_plan(level, note="Tập đúng kỹ thuật"):
+    return {
+        "name": f"Lộ trình {level}",
+        "level": level,
+        "days": [{"day": 1, "workouts": [{"trainingName": "Bài tập 1", "note": note, "order": 1}]}],
+    }
+
+
+def feed_chunks(parser, text, size):
+    plans = []
+    for i in range(0, len(text), size):
+        plans.extend(parser.feed(text[i:i + size]))
+    return plans
+
+
+@pytest.mark.parametrize("size", [1, 2, 7, 64, 100000])
+def test_plans_emitted_for_any_chunk_size(app_module, size):
+    text = json.dumps({"plans": [make_plan(level) for level in LEVELS]}, ensure_ascii=False)
+    parser = app_module.PlanStreamParser()
+
+    plans = feed_chunks(parser, text, size)
+
+    assert [p["level"] for p in plans] == LEVELS
+    assert parser.errors == 0
+    assert not parser.incomplete
+
+
+def test_plan_emitted_as_soon_as_it_closes(app_module):
+    parser = app_module.PlanStreamParser()
+    first = json.dumps(make_plan("Cơ bản"), ensure_ascii=False)
+
+    assert parser.feed('{"plans": [' + first[:-1]) == []
+    assert [p["level"] for p in parser.feed("}, {")] == ["Cơ bản"]
+    assert parser.incomplete
+
+
+def test_root_array(app_module):
+    text = json.dumps([make_plan(level) for level in LEVELS], ensure_ascii=False)
+    parser = app_module.PlanStreamParser()
+
+    assert [p["level"] for p in feed_chunks(parser, text, 5)] == LEVELS
+
+
+def test_braces_inside_strings(app_module):
+    note = 'Giữ nhịp {1-2} và [3], dấu "}" hay "]" \\ không làm đóng object'
+    plans = [make_plan(level, note) for level in LEVELS]
+    text = json.dumps({"plans": plans}, ensure_ascii=False)
+    parser = app_module.PlanStreamParser()
+
+    parsed = feed_chunks(parser, text, 3)
+
+    assert parsed == plans
+    assert parser.errors == 0
+
+
+def test_truncated_output(app_module):
+    text = json.dumps({"plans": [make_plan(level) for level in LEVELS]}, ensure_ascii=False)
+    cut = text.index('"Lộ trình Nâng cao"')
+    parser = app_module.PlanStreamParser()
+
+    parsed = feed_chunks(parser, text[:cut], 4)
+
+    assert [p["level"] for p in parsed] == LEVELS[:2]
+    assert parser.incomplete
+    assert parser.errors == 0
+
+
+def test_invalid_object_is_skipped(app_module):
+    good = [json.dumps(make_plan(level), ensure_ascii=False) for level in LEVELS]
+    text = '{"plans": [' + good[0] + ', {"name": "Lỗi", "days": [1, 2,]}, ' + good[1] + "]}"
+    parser = app_module.PlanStreamParser()
+
+    parsed = feed_chunks(parser, text, 6)
+
+    assert [p["level"] for p in parsed] == LEVELS[:2]
+    assert parser.errors == 1
+    assert not parser.incomplete
@@ -0,0 +1,28 @@
+import uuid
+from decimal import Decimal
+
+import pytest
+from bson import Binary, Decimal128
+
+
+def bson_user():
+    return {
+        "_id": "u1",
+        "name": "An",
+        "goal": ["Tăng sức bền"],
+        "weight": Decimal128(Decimal("62.5")),
+        "deviceId": uuid.UUID("12345678-1234-5678-1234-567812345678"),
+        "avatar": Binary(b"\x00\x01"),
+    }
+
+
+def test_plan_prompt_accepts_any_bson_type(app_module):
+    prompt = app_module.build_plan_prompt(bson_user(), [{"_id": "t1", "name": "Bật nhảy", "level": "Cơ bản"}])
+
+    assert "62.5" in prompt
+    assert "12345678-1234-5678-1234-567812345678" in prompt
+
+
+def test_api_json_still_rejects_unknown_types(app_module):
+    with pytest.raises(TypeError):
+        app_module.dumps_text({"weight": Decimal128(Decimal("62.5"))})